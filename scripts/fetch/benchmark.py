@@ -0,0 +1,197 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+import fetch_ansible_repos
+import fetch_ansible_roles
+import fetch_chef_repos
+import fetch_fixed_puppet_jira_bugs
+import fetch_issues
+import fetch_puppet_repos
+from github_client import GitHubClient
+from simulated_api import SimulatedAPI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import quantitative_analysis
+
+SCENARIOS = ['issues', 'issues-search', 'issues-prepass', 'closure', 'fix-details', 'forge', 'supermarket', 'galaxy-collections', 'galaxy-roles', 'jira']
+
+
+def count_rows(path):
+    with open(path, newline='') as file:
+        return max(sum(1 for _ in csv.reader(file)) - 1, 0)
+
+
+def fix_issues(api, limit):
+    # The (issue URL, fix URL) pairs of the first fix-closed synthetic issues
+    pairs = []
+    for repo, size in api.repositories.items():
+        for number in range(size):
+            closer = api._closer(repo, number)
+            if closer:
+                pairs.append((f"https://github.com/sim/{repo}/issues/{number + 1}", closer['url']))
+            if len(pairs) == limit:
+                return pairs
+    return pairs
+
+
+def write_repositories(api, directory):
+    input_csv = os.path.join(directory, 'repositories.csv')
+    with open(input_csv, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Name', 'Source URL'])
+        for repo in api.repositories:
+            writer.writerow([repo, f"https://github.com/sim/{repo}"])
+    return input_csv
+
+
+def run_issues(api, session, directory, args):
+    input_csv = write_repositories(api, directory)
+    output_csv = os.path.join(directory, 'bugs.csv')
+    fetch_issues.main(input_csv, output_csv, ['simulated-token'], workers=args.workers,
+                      batch_size=args.batch_size, session=session)
+    return count_rows(output_csv), api.expected_issues()
+
+
+def run_issues_search(api, session, directory, args):
+    input_csv = write_repositories(api, directory)
+    output_csv = os.path.join(directory, 'bugs.csv')
+    fetch_issues.main(input_csv, output_csv, ['simulated-token'], workers=args.workers,
+                      session=session, mode='search')
+    # `linked:pr` only finds the issues closed by a pull request
+    return count_rows(output_csv), api.expected_issues(closers=('PullRequest',))
+
+
+def run_issues_prepass(api, session, directory, args):
+    input_csv = write_repositories(api, directory)
+    output_csv = os.path.join(directory, 'bugs.csv')
+    fetch_issues.main(input_csv, output_csv, ['simulated-token'], workers=args.workers,
+                      batch_size=args.batch_size, session=session, prepass=True)
+    # The pre-pass skips the archived repositories
+    return count_rows(output_csv), api.expected_issues(skip_archived=True)
+
+
+def run_closure(api, session, directory, args):
+    client = GitHubClient(['simulated-token'], session=session)
+    pairs = fix_issues(api, args.samples)
+    issues = [quantitative_analysis.parse_url(issue_url) for issue_url, _ in pairs]
+    closures = quantitative_analysis.get_closure_infos(issues, client)
+    found = sum(1 for issue in issues if closures[issue][1])
+    return found, len(pairs)
+
+
+def run_fix_details(api, session, directory, args):
+    client = GitHubClient(['simulated-token'], session=session)
+    pairs = fix_issues(api, args.samples)
+    try:
+        details = quantitative_analysis.get_all_fix_details([(fix_url, 'Puppet') for _, fix_url in pairs], client,
+                                                            args.workers)
+    except Exception:
+        # e.g. an injected 502 that outlasted the retries
+        return 0, len(pairs)
+    # A fix is found once all its files are counted
+    found = 0
+    for (issue_url, _), fix_details in zip(pairs, details):
+        _, repo, number = quantitative_analysis.parse_url(issue_url)
+        if isinstance(fix_details, dict) and \
+                sum(units['lines_added'] for units in fix_details.values()) == api.expected_fix_lines(repo, number - 1):
+            found += 1
+    return found, len(pairs)
+
+
+def run_crawler(module):
+    def run(api, session, directory, args):
+        output_csv = os.path.join(directory, 'output.csv')
+        try:
+            module.main(output_csv, session=session)
+        except Exception as e:
+            # A crawler that crashes (e.g. on an injected 502) keeps whatever it wrote
+            print(f"{module.__name__} failed: {e!r}")
+        if not os.path.exists(output_csv):
+            return 0, None
+        return count_rows(output_csv), None
+    return run
+
+
+RUNNERS = {
+    'issues': run_issues,
+    'issues-search': run_issues_search,
+    'issues-prepass': run_issues_prepass,
+    'closure': run_closure,
+    'fix-details': run_fix_details,
+    'forge': run_crawler(fetch_puppet_repos),
+    'supermarket': run_crawler(fetch_chef_repos),
+    'galaxy-collections': run_crawler(fetch_ansible_repos),
+    'galaxy-roles': run_crawler(fetch_ansible_roles),
+    'jira': run_crawler(fetch_fixed_puppet_jira_bugs),
+}
+
+
+def run_scenario(name, args):
+    """
+    Runs one scenario against a fresh simulated API and returns its measurements.
+    """
+    api = SimulatedAPI(repositories=args.repositories, mean_issues=args.mean_issues,
+                       registry_size=args.registry_size, latency=args.latency, error_rate=args.error_rate,
+                       rate_limit=args.rate_limit, window=args.rate_limit_window,
+                       max_page_size=args.max_page_size, seed=args.seed)
+    session = requests.Session()
+    session.mount('https://', api)
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        items, expected = RUNNERS[name](api, session, directory, args)
+        wall_time = time.perf_counter() - start
+    return {
+        'scenario': name,
+        'wall_time': wall_time,
+        'requests': api.requests,
+        'requests_per_sec': api.requests / wall_time if wall_time else 0,
+        'items': items,
+        'expected_items': expected,
+        'items_per_sec': items / wall_time if wall_time else 0,
+        'points': api.points,
+        'points_per_item': api.points / items if items and api.points else None,
+        'injected_errors': api.errors,
+    }
+
+
+def print_report(results):
+    columns = ['scenario', 'wall_time', 'requests', 'requests_per_sec', 'items', 'expected_items',
+               'items_per_sec', 'points', 'points_per_item', 'injected_errors']
+    rows = [[f"{row[column]:.3f}" if isinstance(row[column], float) else str(row[column]) for column in columns]
+            for row in results]
+    widths = [max(len(column), *(len(row[index]) for row in rows)) for index, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the harvest throughput of the data collection scripts against a simulated API.')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS, help='Scenarios to run (default: all).')
+    parser.add_argument('--repositories', type=int, default=200, help='Number of synthetic GitHub repositories.')
+    parser.add_argument('--mean-issues', type=int, default=30, help='Mean number of closed issues per repository.')
+    parser.add_argument('--registry-size', type=int, default=300, help='Number of synthetic modules, cookbooks, collections, roles and Jira issues.')
+    parser.add_argument('--samples', type=int, default=100, help='Number of bugs used by the closure and fix-details scenarios.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Injected latency per request in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of a 502 response.')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='GitHub rate limit points per window.')
+    parser.add_argument('--rate-limit-window', type=int, default=3600, help='Length of the rate limit window in seconds.')
+    parser.add_argument('--max-page-size', type=int, default=None, help='Number of issues per GraphQL query above which the simulated API times out.')
+    parser.add_argument('--workers', type=int, default=1, help='--workers of fetch_issues.py.')
+    parser.add_argument('--batch-size', type=int, default=1, help='--batch-size of fetch_issues.py.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data and of the injected errors.')
+    parser.add_argument('--json', type=str, default=None, help='Also save the results to this JSON file.')
+    args = parser.parse_args()
+
+    results = [run_scenario(name, args) for name in args.scenarios]
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+
+class Checkpoint:
+    """
+    Persistent progress record of a long-running harvest.
+
+    The checkpoint is an append-only JSON-lines journal with one entry per fetched page
+    (the cursor to continue from) and one entry per finished item, so recording progress costs
+    a single small write and a crash can lose at most the entry being written.
+    The first entry holds the time the run started, which a resumed run keeps.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.processed = set()
+        self.cursors = {}
+        self.rows = {}
+        self.started = None
+        self._lock = threading.Lock()
+        self._partial_line = False
+        if resume and os.path.exists(path):
+            self._load()
+        self._file = open(path, 'a' if resume else 'w')
+        if self._partial_line:
+            # Terminate the partially written last line before appending
+            self._file.write('\n')
+        if self.started is None:
+            self.started = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            self._append({'started': self.started})
+
+    def _load(self):
+        with open(self.path) as journal:
+            for line in journal:
+                self._partial_line = not line.endswith('\n')
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partially written last line of an interrupted run
+                    continue
+                if 'started' in entry:
+                    self.started = entry['started']
+                    continue
+                key = entry['key']
+                if entry.get('done'):
+                    self.processed.add(key)
+                    self.cursors.pop(key, None)
+                else:
+                    self.cursors[key] = entry['cursor']
+                    if 'rows' in entry:
+                        self.rows[key] = entry['rows']
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+
+    def is_processed(self, key):
+        return key in self.processed
+
+    def get_cursor(self, key):
+        return self.cursors.get(key)
+
+    def get_rows(self, key):
+        # The number of output rows written when the cursor of key was saved, if recorded
+        return self.rows.get(key)
+
+    def save_cursor(self, key, cursor, rows=None):
+        with self._lock:
+            self.cursors[key] = cursor
+            entry = {'key': key, 'cursor': cursor}
+            if rows is not None:
+                self.rows[key] = rows
+                entry['rows'] = rows
+            self._append(entry)
+
+    def mark_processed(self, key):
+        with self._lock:
+            self.processed.add(key)
+            self.cursors.pop(key, None)
+            self._append({'key': key, 'done': True})
+
+    def close(self):
+        self._file.close()
+
+
+class JournalStore:
+    """
+    A persistent key/value store of JSON values (e.g. the cached details of every cookbook).
+
+    Updates are appended to a JSON-lines file, so that storing a value costs a single small write
+    and an interrupted run keeps everything stored before; the file is compacted to a single entry
+    per key whenever it is loaded.
+    """
+
+    # Name of the value in the entries of the file
+    FIELD = 'value'
+
+    def __init__(self, path):
+        self.path = path
+        self.values = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if self.FIELD in entry:
+                        self.values[entry['key']] = entry[self.FIELD]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as compacted:
+            for key, value in self.values.items():
+                compacted.write(json.dumps({'key': key, self.FIELD: value}) + '\n')
+        os.replace(tmp_path, path)
+        self._file = open(path, 'a')
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def update(self, key, value):
+        with self._lock:
+            self.values[key] = value
+            self._file.write(json.dumps({'key': key, self.FIELD: value}) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class HighWaterMarks(JournalStore):
+    """
+    Per-item high-water marks (e.g. the time a repository was last harvested completely) that
+    persist across runs, so that a later run only needs to ask for what changed since then.
+    """
+
+    FIELD = 'mark'
+
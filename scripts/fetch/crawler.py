@@ -0,0 +1,322 @@
+import csv
+import os
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from checkpoint import Checkpoint
+from http_session import get_json
+from metrics import metrics_of
+from ratelimit import RequestRateLimiter
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'ResearchProject/1.0',
+    'Accept': 'application/json',
+}
+
+
+class OffsetPagination:
+    """
+    Pagination by offset (e.g. `?limit=100&offset=200`) of a listing that reports its total size.
+    The first page tells the total, so the remaining pages are fetched concurrently.
+
+    Parameters:
+    - url (str): The URL of the listing.
+    - items (callable): Returns the items of a page.
+    - total (callable): Returns the total number of items reported by a page.
+    - page_size (int): The number of items asked for per page.
+    - limit_param, offset_param (str): The names of the page size and offset parameters.
+    - params (dict): Additional query parameters.
+    - returned_size (callable): If given, returns the page size the API actually used (some APIs
+      return fewer items per page than asked for).
+    """
+
+    def __init__(self, url, items, total, page_size=100, limit_param='limit', offset_param='offset',
+                 params=None, returned_size=None):
+        self.url = url
+        self.items = items
+        self.total = total
+        self.page_size = page_size
+        self.limit_param = limit_param
+        self.offset_param = offset_param
+        self.params = params or {}
+        self.returned_size = returned_size
+
+    def _params(self, offset, page_size):
+        return dict(self.params, **{self.limit_param: page_size, self.offset_param: offset})
+
+    def pages(self, crawler, state=None):
+        """
+        Returns a generator of (page, state) tuples in listing order, where state is the offset
+        to resume from once the page is processed (None after the last page), starting from the
+        offset given as state. Stops at the first page that could not be retrieved.
+        """
+        start = state or 0
+        first_page = crawler.get_json(self.url, self._params(start, self.page_size))
+        if first_page is None:
+            return
+        total = self.total(first_page)
+        metrics_of(crawler.session).expect(total - start)
+        page_size = (self.returned_size(first_page) if self.returned_size else None) or self.page_size
+        offsets = range(start + page_size, total, page_size)
+        yield first_page, (offsets[0] if offsets else None)
+        pages = crawler.map_pages(lambda offset: crawler.get_json(self.url, self._params(offset, page_size)), offsets)
+        for offset, page in zip(offsets, pages):
+            if page is None:
+                return
+            yield page, (offset + page_size if offset + page_size < total else None)
+
+
+class StartItemsPagination(OffsetPagination):
+    """
+    Offset pagination with `start`/`items` parameters (e.g. the Chef Supermarket API).
+    """
+
+    def __init__(self, url, items, total, page_size=100, params=None):
+        super().__init__(url, items, total, page_size, limit_param='items', offset_param='start', params=params)
+
+
+class NextLinkPagination:
+    """
+    Pagination that follows the link to the next page given by every page (e.g. `"next": "/api/v1/roles/?page=2"`).
+    Pages are fetched one after the other, and the next link is the state to resume from.
+
+    Parameters:
+    - url (str): The URL of the first page.
+    - items (callable): Returns the items of a page.
+    - next_link (callable): Returns the (absolute or relative) link to the next page, or None.
+    """
+
+    def __init__(self, url, items, next_link):
+        self.url = url
+        self.items = items
+        self.next_link = next_link
+
+    def pages(self, crawler, state=None):
+        url = state or self.url
+        while url:
+            page = crawler.get_json(url)
+            if page is None:
+                return
+            url = self.next_link(page)
+            if url:
+                url = urljoin(self.url, url)
+            yield page, url
+
+
+class CursorPagination:
+    """
+    Pagination by an opaque cursor that every page returns for the next one (e.g. `nextPageToken`).
+    Pages are fetched one after the other, and the cursor is the state to resume from.
+
+    Parameters:
+    - url (str): The URL of the listing.
+    - items (callable): Returns the items of a page.
+    - cursor (callable): Returns the cursor of the next page, or None after the last page.
+    - cursor_param (str): The name of the cursor parameter.
+    - params (dict): Additional query parameters.
+    """
+
+    def __init__(self, url, items, cursor, cursor_param='cursor', params=None):
+        self.url = url
+        self.items = items
+        self.cursor = cursor
+        self.cursor_param = cursor_param
+        self.params = params or {}
+
+    def pages(self, crawler, state=None):
+        cursor = state
+        while True:
+            params = dict(self.params, **({self.cursor_param: cursor} if cursor else {}))
+            page = crawler.get_json(self.url, params)
+            if page is None:
+                return
+            cursor = self.cursor(page)
+            yield page, cursor
+            if not cursor:
+                return
+
+
+class Source:
+    """
+    The definition of a registry to crawl.
+
+    Parameters:
+    - name (str): The name of the source, its key in the checkpoint.
+    - pagination: How to page through the listing (OffsetPagination, StartItemsPagination,
+      NextLinkPagination or CursorPagination).
+    - header (list): The header of the output CSV.
+    - row (callable): Called as row(item, crawler) for every item of the listing; returns the
+      output row of the item, or None to leave it out.
+    - resolve (bool): Whether row makes requests of its own (e.g. to look up the details of the
+      item, with crawler.get_json), in which case the items are resolved concurrently.
+    """
+
+    def __init__(self, name, pagination, header, row, resolve=False):
+        self.name = name
+        self.pagination = pagination
+        self.header = header
+        self.row = row
+        self.resolve = resolve
+
+
+class CsvSink:
+    """
+    Writes rows to a CSV file as they arrive, keeping every row (duplicates included).
+
+    When appending to resume a crawl, the rows after the first `rows` ones (those of the pages
+    recorded in the checkpoint) belong to the interrupted page, which is fetched again; while that
+    page is written, its rows already in the file are skipped.
+    """
+
+    def __init__(self, path, header, append=False, rows=0):
+        self.rows = 0
+        self.replayed = Counter()
+        if append:
+            with open(path, newline='') as csvfile:
+                reader = csv.reader(csvfile)
+                next(reader, None)  # Skip header
+                existing = [tuple(row) for row in reader if row]
+            self.rows = len(existing)
+            self.replayed = Counter(existing[rows:])
+        self.file = open(path, 'a' if append else 'w', newline='')
+        self.writer = csv.writer(self.file)
+        if not append:
+            self.writer.writerow(header)
+
+    def write(self, row):
+        # The rows as read back from the file
+        key = tuple('' if value is None else str(value) for value in row)
+        if self.replayed[key]:
+            self.replayed[key] -= 1
+            return
+        self.rows += 1
+        self.writer.writerow(row)
+
+    def flush(self):
+        # Called after every page; only the first page after a resume can have been written before
+        self.replayed.clear()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Crawler:
+    """
+    Crawls registry sources over a shared pooled session.
+
+    Listing pages are fetched concurrently when the pagination allows it, and the items of every
+    page are resolved by a pool of workers threads while the next pages are still being fetched.
+    Every host gets its own cap of concurrent requests and requests per second (workers and rate
+    by default, overridden per host by host_limits, e.g. {'galaxy.ansible.com': (4, 5)}), and
+    failed requests are retried with backoff.
+    """
+
+    def __init__(self, session, workers=8, rate=None, host_limits=None, headers=None, retries=5):
+        self.session = session
+        self.workers = workers
+        self.rate = rate
+        self.host_limits = host_limits or {}
+        self.headers = headers or DEFAULT_HEADERS
+        self.retries = retries
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._page_executor = None
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                concurrency, rate = self.host_limits.get(host, (self.workers, self.rate))
+                self._hosts[host] = (threading.BoundedSemaphore(concurrency), RequestRateLimiter(rate))
+            return self._hosts[host]
+
+    def get_json(self, url, params=None):
+        """
+        Sends a GET request within the caps of the host and returns the decoded JSON response,
+        or None if it could not be retrieved (see http_session.get_json).
+        """
+        semaphore, limiter = self._host(url)
+        with semaphore:
+            return get_json(self.session, url, params=params, headers=self.headers, limiter=limiter,
+                            retries=self.retries)
+
+    def map_pages(self, fetch, arguments):
+        # Fetches pages concurrently; returns an iterator of the pages in order
+        return self._page_executor.map(fetch, arguments)
+
+    def crawl(self, source, state=None):
+        """
+        Crawls a source from the given state (None for the beginning).
+
+        Returns:
+        - generator: A (rows, state) tuple for every page, in listing order, with the rows of the
+          page and the state to resume from once they are processed (None after the last page).
+          The generator stops early at a page that could not be retrieved.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as page_executor, \
+                ThreadPoolExecutor(max_workers=self.workers) as resolver_executor:
+            self._page_executor = page_executor
+            # The items of a page are resolved while the rows of the previous page are collected
+            pending = deque()
+            for page, next_state in source.pagination.pages(self, state):
+                items = source.pagination.items(page)
+                if source.resolve:
+                    rows = [resolver_executor.submit(source.row, item, self) for item in items]
+                else:
+                    rows = [source.row(item, self) for item in items]
+                pending.append((rows, next_state, len(items)))
+                while len(pending) > 1:
+                    yield self._collect(*pending.popleft())
+            while pending:
+                yield self._collect(*pending.popleft())
+
+    def _collect(self, rows, state, count):
+        rows = [row.result() if hasattr(row, 'result') else row for row in rows]
+        metrics_of(self.session).done(count)
+        return [row for row in rows if row is not None], state
+
+    def run(self, source, output, resume=False):
+        """
+        Crawls a source into a CSV file, writing the rows of every page as soon as they are
+        resolved, and records the state of the crawl (and the number of rows written) in
+        <output>.checkpoint after every page, so that an interrupted crawl continues with resume
+        from where it stopped.
+
+        Returns:
+        - bool: Whether the crawl was completed.
+        """
+        checkpoint = Checkpoint(output + '.checkpoint', resume=resume)
+        if checkpoint.is_processed(source.name):
+            print(f"{source.name} was already crawled completely.")
+            checkpoint.close()
+            return True
+        sink = CsvSink(output, source.header, append=resume and os.path.exists(output),
+                       rows=checkpoint.get_rows(source.name) or 0)
+        completed = False
+        for rows, state in self.crawl(source, checkpoint.get_cursor(source.name)):
+            for row in rows:
+                sink.write(row)
+            sink.flush()
+            if state is None:
+                checkpoint.mark_processed(source.name)
+                completed = True
+            else:
+                checkpoint.save_cursor(source.name, state, rows=sink.rows)
+        sink.close()
+        checkpoint.close()
+        if not completed:
+            print(f"Stopped crawling {source.name} at a page that could not be retrieved; run again with --resume to continue from there.")
+        return completed
+
+
+def add_crawler_arguments(parser, rate=10, resume=True):
+    """
+    Adds the command line options shared by the registry crawlers.
+    """
+    parser.add_argument('--workers', type=int, default=8, help='Number of pages and items fetched concurrently.')
+    parser.add_argument('--rate', type=float, default=rate, help=f'Maximum number of requests per second and host (default: {rate}).')
+    if resume:
+        parser.add_argument('--resume', action='store_true', help='Continue an interrupted crawl from its checkpoint, appending to the output CSV.')
@@ -1,60 +1,40 @@
-import requests
-import pprint
-import csv
 import argparse
 
-API_URL = 'https://galaxy.ansible.com/api/v1/roles/'
+from crawler import Crawler, NextLinkPagination, Source
+from http_session import add_session_arguments, make_session, session_from_args
 
-def get_roles(url):
-    response = requests.get(url)
-
-    if response.status_code == 200:
-        return response.json()
-    else:
-        # print(f'Failed to retrieve collections: {response.status_code}')
-        return None
-
-def get_repo_url(url):
-    base_url = 'https://galaxy.ansible.com'
-    page_url = f'{base_url}{url}' 
-    response = requests.get(page_url)
-    if response.status_code == 200:
-        json_obj = response.json()
-        repo_url = json_obj["metadata"]['repository']
-        return repo_url
-    else:
-        # print(f'Failed to retrieve collections: {response.status_code}')
-        return None
-
-def main(output):
-    next_page_url = API_URL
-    all_roles = []
-
-    while next_page_url:
-        result = get_roles(next_page_url)
-        if result is not None:
-            for entry in result['results']:
-                all_roles.append("https://github.com/"+entry["github_user"]+"/"+entry["github_repo"])
-                # print("Fetched", len(all_roles), "roles so far...")
-        if "next" in result:
-            next_page_url = result['next']  # Get the next page URL
-        else:
-            break
-
-    with open(output, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        # Write the header
-        writer.writerow(['Name'])
-        # Write the project data
-        for info in all_roles:
-            writer.writerow([info])
-
-    # driver.quit()  # Don't forget to quit the driver!
+API_URL = 'https://galaxy.ansible.com/api/v1/roles/'
+# Larger page sizes are capped by the API to its maximum
+PAGE_SIZE = 1000
+# Key of the listing in the checkpoint
+CHECKPOINT_KEY = 'roles'
+
+def role_row(entry, crawler=None):
+    return ["https://github.com/"+entry["github_user"]+"/"+entry["github_repo"]]
+
+SOURCE = Source(
+    CHECKPOINT_KEY,
+    NextLinkPagination(f"{API_URL}?page_size={PAGE_SIZE}", items=lambda page: page['results'],
+                       next_link=lambda page: page.get('next')),
+    header=['Name'],
+    row=role_row,
+)
+
+def main(output, session=None, resume=False):
+    """
+    Crawls the role listing page by page, appending the rows of every page to the CSV and saving
+    the URL of the next page in <output>.checkpoint, so that an interrupted crawl continues with
+    --resume from the page it stopped at.
+    """
+    crawler = Crawler(session or make_session(), workers=1)
+    crawler.run(SOURCE, output, resume)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fetch GitHub repositories of Ansible Roles.')
     parser.add_argument('output_csv', type=str, help='Output CSV file path to save the repository URLs.')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted crawl from its checkpoint, appending to the output CSV.')
+    add_session_arguments(parser)
     args = parser.parse_args()
 
-    main(args.output_csv)
\ No newline at end of file
+    main(args.output_csv, session_from_args(args), args.resume)
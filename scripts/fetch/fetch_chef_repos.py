@@ -1,66 +1,78 @@
-import requests
-import time
-import csv
 import argparse
 
-def get_all_cookbooks(start, items):
-    cookbooks = []
-    base_url = "https://supermarket.chef.io/api/v1/cookbooks"
-    params = {
-        'start': start,
-        'items': items,
-    }
-    cookbooks = []
+from checkpoint import JournalStore
+from crawler import Crawler, Source, StartItemsPagination, add_crawler_arguments
+from http_session import add_session_arguments, make_session, session_from_args
 
-    while True:
-        response = requests.get(base_url, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            for cookbook in data['items']:
-                cookbooks.append(cookbook['cookbook'])
-            if len(data['items']) < items:
-                break  # We've reached the end of the cookbooks list
-            params['start'] += items  # Prepare the 'start' for the next batch of cookbooks
-        else:
-            # print(f"Failed to retrieve cookbooks: {response.status_code}")
-            break  # Exit the loop if there's an error
-        time.sleep(1)  # Pause to avoid hitting rate limits
+BASE_URL = "https://supermarket.chef.io/api/v1/cookbooks"
+# All the versions of all the cookbooks, in a single response
+UNIVERSE_URL = "https://supermarket.chef.io/universe"
 
-    return cookbooks
 
-def get_cookbook_source_url(url):
-    response = requests.get(url)
-    if response.status_code == 200:
-        data = response.json()
-        return data['source_url']
-    else:
+def version_key(version):
+    # Orders version strings numerically, e.g. 1.10.0 after 1.9.2
+    return [int(part) if part.isdigit() else 0 for part in version.split('.')]
+
+def get_latest_versions(crawler):
+    """
+    Returns the latest version of every cookbook according to the Supermarket universe,
+    or an empty dict if the universe could not be retrieved.
+    """
+    universe = crawler.get_json(UNIVERSE_URL) or {}
+    return {name: max(versions, key=version_key) for name, versions in universe.items() if versions}
+
+def resolve_cookbook(url, crawler, details, latest_versions):
+    """
+    Returns the source URL of a cookbook. Details are cached by cookbook version, so a cookbook
+    is only looked up again once it has a new version; without the universe (latest_versions
+    is empty), the cached details of a previous or interrupted run are reused.
+    """
+    name = url.split("https://supermarket.chef.io/api/v1/cookbooks/")[1]
+    cached = details.get(name)
+    if cached and (not latest_versions or cached['version'] == latest_versions.get(name)):
+        return cached['source_url']
+    data = crawler.get_json(url)
+    if data is None:
         return None
+    version = data.get('latest_version', '').rstrip('/').rsplit('/', 1)[-1]
+    details.update(name, {'version': latest_versions.get(name, version), 'source_url': data['source_url']})
+    return data['source_url']
+
+def cookbook_source(details, latest_versions):
+    # The Supermarket listing, with the source URL of every cookbook looked up (or taken from the cache)
+    def cookbook_row(cookbook, crawler):
+        url = cookbook['cookbook']
+        source_url = resolve_cookbook(url, crawler, details, latest_versions)
+        if source_url and "github" in source_url:
+            return url.split("https://supermarket.chef.io/api/v1/cookbooks/")[1], source_url
+        return None
+
+    return Source(
+        'chef-supermarket',
+        StartItemsPagination(BASE_URL, items=lambda page: page['items'], total=lambda page: page['total']),
+        header=['Name', 'Source URL'],
+        row=cookbook_row,
+        resolve=True,
+    )
 
-def main(output):
-    cookbooks = get_all_cookbooks(0, 100)
-    count = 0
-    repo_urls = []
-    for cookbook in cookbooks:
-        count+=1
-        source_url = get_cookbook_source_url(cookbook)
-        name = cookbook.split("https://supermarket.chef.io/api/v1/cookbooks/")[1]
-        if source_url:
-            if "github" in source_url:
-                repo_urls.append((name, source_url))
-        if count % 100 == 0:
-            time.sleep(1)
-    
-    with open(output, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        # Write the header
-        writer.writerow(['Name', 'Source URL'])
-        # Write the project data
-        for info in repo_urls:
-            writer.writerow(info)
+def main(output, session=None, workers=8, rate=50, resume=False):
+    """
+    Resolves the cookbook details concurrently (workers threads sharing the session's connection
+    pool, at most rate requests per second) while the listing pages are still being fetched.
+    Resolved details are kept in <output>.details, so an interrupted crawl resumes where it stopped
+    and a later crawl only looks up the cookbooks with a new version.
+    """
+    crawler = Crawler(session or make_session(pool_size=workers), workers, rate)
+    details = JournalStore(output + '.details')
+    latest_versions = get_latest_versions(crawler)
+    crawler.run(cookbook_source(details, latest_versions), output, resume)
+    details.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fetch GitHub repositories of Chef Cookbooks.')
     parser.add_argument('output_csv', type=str, help='Output CSV file path to save the repository URLs.')
+    add_crawler_arguments(parser, rate=50)
+    add_session_arguments(parser)
     args = parser.parse_args()
 
-    main(args.output_csv)
+    main(args.output_csv, session_from_args(args, pool_size=args.workers), args.workers, args.rate, args.resume)
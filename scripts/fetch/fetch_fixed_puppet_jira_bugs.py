@@ -1,80 +1,170 @@
-import requests
 from requests.auth import HTTPBasicAuth
 import re
+import os
 import argparse
+from datetime import datetime, timedelta, timezone
 
+from checkpoint import HighWaterMarks
+from crawler import Crawler, OffsetPagination, Source, add_crawler_arguments
+from http_session import add_session_arguments, make_session, session_from_args
 
+JIRA_URL = "https://puppet.atlassian.net"
+SEARCH_API = "/rest/api/3/search"
+HEADERS = {"Accept": "application/json"}
+JQL = "project in (PUP, MODULES)  and type = Bug and status in (Closed, Resolved) ORDER BY created DESC"
+# Issues updated since the last sync, whatever their status, so that reopened issues are found too
+INCREMENTAL_JQL = 'project in (PUP, MODULES)  and type = Bug and updated >= "{since}" ORDER BY created DESC'
+FIXED_STATUSES = ('Closed', 'Resolved')
+# Key of the time of the last complete sync in <output>.marks
+SYNC_MARK = 'jira'
 
-def has_github_url_in_comments(issue_key):
-    jira_url = "https://puppet.atlassian.net"
-    headers = {"Accept": "application/json"}
-    comments_url = f"{jira_url}/rest/api/3/issue/{issue_key}/comment"
-    comments_response = requests.get(comments_url, headers=headers)
-    if comments_response.status_code == 200:
-        comments_json = comments_response.json()
-        
-        # Function to recursively search for GitHub URLs in the document structure
-        def search_for_github_url(node):
-            # Check if this node contains the text with a GitHub URL
-            if node.get('type') == 'text' and 'text' in node:
-                if re.search(r'https://github\.com/[^\s]+/(commit|pull)/[^\s]+', node['text']):
-                    return True
-            # Recursively search in nested content
-            if 'content' in node:
-                for child in node['content']:
-                    if search_for_github_url(child):
-                        return True
+
+# Function to recursively search for GitHub URLs in the document structure
+def search_for_github_url(node):
+    # Check if this node contains the text with a GitHub URL
+    if node.get('type') == 'text' and 'text' in node:
+        if re.search(r'https://github\.com/[^\s]+/(commit|pull)/[^\s]+', node['text']):
+            return True
+    # Recursively search in nested content
+    if 'content' in node:
+        for child in node['content']:
+            if search_for_github_url(child):
+                return True
+    return False
+
+def get_comments(issue_key, crawler, start_at=0):
+    # Returns one page of the comments of an issue, or None if it could not be retrieved
+    comments_url = f"{JIRA_URL}/rest/api/3/issue/{issue_key}/comment"
+    params = {'startAt': start_at, 'maxResults': 100}
+    return crawler.get_json(comments_url, params=params)
+
+def has_github_url_in_comments(issue_key, crawler, start_at=0):
+    # Fetches the comments of an issue from start_at on, page by page, until one has a GitHub URL
+    while True:
+        comments_json = get_comments(issue_key, crawler, start_at)
+        if comments_json is None or not comments_json.get('comments'):
             return False
-        
-        for comment in comments_json.get('comments', []):
+        for comment in comments_json['comments']:
             if search_for_github_url(comment['body']):
                 return True
-    return False
+        start_at += len(comments_json['comments'])
+        if start_at >= comments_json.get('total', 0):
+            return False
 
+def has_github_url(issue, crawler):
+    """
+    Checks the comments of an issue of a search response for a GitHub commit or pull request URL.
+    The search response embeds the first comments of every issue; the remaining comments are only
+    fetched if none of those matches.
+    """
+    comment_field = issue['fields'].get('comment')
+    if comment_field is None:
+        return has_github_url_in_comments(issue['key'], crawler)
+    for comment in comment_field['comments']:
+        if search_for_github_url(comment['body']):
+            return True
+    if len(comment_field['comments']) < comment_field['total']:
+        return has_github_url_in_comments(issue['key'], crawler, len(comment_field['comments']))
+    return False
 
+def is_fixed(issue, crawler):
+    # A closed or resolved issue with a comment that links a GitHub commit or pull request
+    status = (issue['fields'].get('status') or {}).get('name', FIXED_STATUSES[0])
+    return status in FIXED_STATUSES and has_github_url(issue, crawler)
 
+def issue_row(issue, crawler):
+    return f"{JIRA_URL}/browse/{issue['key']}", is_fixed(issue, crawler)
 
-def main(output):
-    # Define your JIRA instance URL, JQL query, API endpoint, authentication details, and headers
-    start_at = 0
-    max_results = 100
-    total_issues_fetched = 0
-    jql = "project in (PUP, MODULES)  and type = Bug and status in (Closed, Resolved) ORDER BY created DESC"
-    jira_url = "https://puppet.atlassian.net"
-    search_api = "/rest/api/3/search"
-    headers = {"Accept": "application/json"}
-    with open(output, 'w') as file:
-        file.write("Issue URL" + '\n')
-        while True:
-            params = {'jql': jql, 'startAt': start_at, 'maxResults': max_results}
-            response = requests.request("GET", jira_url + search_api, headers=headers, params=params)
+def issue_source(jql):
+    # The JQL search, with the comments and the status of every issue embedded in its pages
+    return Source(
+        'jira',
+        # Jira may return fewer results per page than asked for
+        OffsetPagination(JIRA_URL + SEARCH_API, items=lambda page: page['issues'], total=lambda page: page['total'],
+                         limit_param='maxResults', offset_param='startAt', params={'jql': jql, 'fields': 'comment,status'},
+                         returned_size=lambda page: page['maxResults']),
+        header=['Issue URL'],
+        row=issue_row,
+        resolve=True,
+    )
 
-            if response.status_code == 200:
-                response_json = response.json()
+def check_issues(crawler, jql, stats):
+    """
+    Fetches the first page of the JQL search, which tells the total number of issues, then the
+    remaining pages concurrently. The comments are part of the search response, so only issues
+    with more comments than the response embeds need further requests, which run concurrently
+    as well.
 
-                issues = response_json['issues']
-                total_issues = response_json['total']
+    Returns:
+    - generator: An (issue URL, fixed) tuple for every issue, in search order. The search stops at
+      a page that could not be retrieved; stats['completed'] tells whether it reached the end.
+    """
+    stats['completed'] = False
+    for rows, state in crawler.crawl(issue_source(jql)):
+        yield from rows
+        stats['completed'] = state is None
 
-                for issue in issues:
-                    issue_key = issue['key']
-                    # Check each issue for comments with GitHub URLs
-                    if has_github_url_in_comments(issue_key):
-                        issue_url = f"{jira_url}/browse/{issue_key}"
-                        file.write(issue_url + '\n')
-                        total_issues_fetched += 1
+def read_issue_urls(output):
+    with open(output) as file:
+        next(file, None)  # Skip header
+        return [line.strip() for line in file if line.strip()]
 
-                if not issues:
-                    break
+def sync(output, crawler, since, stats):
+    """
+    Re-checks the issues updated since the given time and merges them into the existing output:
+    fixed issues that are missing are added (at the top, as the newest issues come first), and
+    listed issues that no longer qualify (e.g. reopened ones) are removed.
+    """
+    # Jira compares the time in the time zone of the instance, so a day of margin is re-checked
+    since = (datetime.fromisoformat(since) - timedelta(days=1)).strftime('%Y/%m/%d %H:%M')
+    issue_urls = read_issue_urls(output)
+    listed = set(issue_urls)
+    added, removed = [], set()
+    for issue_url, fixed in check_issues(crawler, INCREMENTAL_JQL.format(since=since), stats):
+        if fixed and issue_url not in listed:
+            added.append(issue_url)
+            listed.add(issue_url)
+        elif not fixed and issue_url in listed:
+            removed.add(issue_url)
+    with open(output, 'w') as file:
+        file.write("Issue URL" + '\n')
+        for issue_url in added + [issue_url for issue_url in issue_urls if issue_url not in removed]:
+            file.write(issue_url + '\n')
+    print(f"Added {len(added)} and removed {len(removed)} issues.")
 
-                start_at += max_results
-            else:
-                # print(f"Failed to fetch issues: {response.status_code}")
-                break
+def main(output, session=None, workers=8, rate=10, incremental=False):
+    """
+    Fetches the fixed Puppet Jira issues (workers threads, at most rate requests per second).
+    The time of every complete run is kept in <output>.marks; with incremental, only the issues
+    updated since the last complete run are checked and merged into the existing output.
+    """
+    crawler = Crawler(session or make_session(pool_size=2 * workers), workers, rate, headers=HEADERS)
+    marks = HighWaterMarks(output + '.marks')
+    started = datetime.now(timezone.utc).isoformat()
+    stats = {}
+    last_sync = marks.get(SYNC_MARK) if incremental and os.path.exists(output) else None
+    if last_sync:
+        sync(output, crawler, last_sync, stats)
+    else:
+        with open(output, 'w') as file:
+            file.write("Issue URL" + '\n')
+            # Issues are written in search order as their pages arrive
+            for issue_url, fixed in check_issues(crawler, JQL, stats):
+                if fixed:
+                    file.write(issue_url + '\n')
+    if stats['completed']:
+        marks.update(SYNC_MARK, started)
+    else:
+        print("The search stopped at a page that could not be retrieved; the sync time is not updated.")
+    marks.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fetch closed issues from Puppet Modules on Jira.')
     parser.add_argument('output_csv', type=str, help='Output CSV file path to save the issue URLs.')
+    add_crawler_arguments(parser, resume=False)
+    parser.add_argument('--incremental', action='store_true', help='Only re-check the issues updated since the last complete run and merge them into the output CSV.')
+    add_session_arguments(parser)
 
     args = parser.parse_args()
-    main(args.output_csv)
\ No newline at end of file
+    main(args.output_csv, session_from_args(args, pool_size=2 * args.workers), args.workers, args.rate, args.incremental)
@@ -1,10 +1,20 @@
-import requests
 import re
 import csv
 import json
-import time
-from datetime import datetime, timezone
+import os
 import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+
+import requests
+
+from checkpoint import Checkpoint, HighWaterMarks
+from github_client import GitHubClient, load_tokens
+from http_session import add_session_arguments, make_session, session_from_args
+from metrics import metrics_of
+from repo_registry import canonical_name, parse_github_url, read_repository_urls
 
 # Input file path
 # input_csv = '../../data/urls/ansible_roles_urls.csv'
@@ -13,44 +23,19 @@ import argparse
 
 
 
-def parse_github_url(url):
-    if url.endswith('.git'):
-        url = url[:-4]
-    # Check if the URL is SSH format
-    if url.startswith('git@github.com:'):
-        url = url.replace('git@github.com:', 'https://github.com/')
-    
-    path = url.split('/')
-    if len(path)>1:
-      owner = path[-2]
-      repo = path[-1]
-      return owner, repo
-    else:
-      # print("Error", url)
-      return None, None
-
-def get_repo_issues(owner, repo, headers):
-    issues = []
-    cursor = None  # Used for pagination
-    remaining_limit = 5000
+# Issue fields requested by each query profile. Only the URL is written to the output CSV,
+# so the heavier profiles (e.g. the full body, for contains_code_block) are opt-in.
+QUERY_PROFILES = {
+    'urls-only': ['url'],
+    'triage': ['url', 'title', 'closedAt'],
+    'full': ['url', 'title', 'body', 'closedAt'],
+}
 
-    while True:
-        # GraphQL query. Using triple quotes for multi-line string
-        query = """
-        {{
-          rateLimit {{
-            cost
-            remaining
-            resetAt
-          }}
-          repository(owner: "{owner}", name: "{repo}") {{
-            issues(first: 100, after: {cursor}, states: CLOSED) {{
+# Selection of one page of closed issues, shared by the per-repository and the batched queries
+ISSUES_CONNECTION = """
+            issues(first: {first}, after: {cursor}, states: CLOSED{filter}) {{
               edges {{
-                node {{
-                  title
-                  body
-                  url
-                  closedAt
+                node {{{fields}
                   timelineItems(last: 1, itemTypes: [CLOSED_EVENT]) {{
                     edges {{
                       node {{
@@ -69,40 +54,368 @@ def get_repo_issues(owner, repo, headers):
                 endCursor
                 hasNextPage
               }}
+            }}"""
+
+# Selection of one page of issue search results (see get_repo_issues_by_search)
+SEARCH_CONNECTION = """
+          search(query: {query}, type: ISSUE, first: {first}, after: {cursor}) {{
+            issueCount
+            edges {{
+              node {{
+                ... on Issue {{{fields}
+                  timelineItems(last: 1, itemTypes: [CLOSED_EVENT]) {{
+                    edges {{
+                      node {{
+                        __typename
+                        ... on ClosedEvent {{
+                          closer {{
+                            __typename
+                          }}
+                        }}
+                      }}
+                    }}
+                  }}
+                }}
+              }}
+            }}
+            pageInfo {{
+              endCursor
+              hasNextPage
+            }}
+          }}"""
+
+# Search qualifiers of the candidate bugs. `linked:pr` matches the issues linked to a pull request,
+# i.e. most of the issues closed by one; issues closed by a commit need e.g. `reason:completed`.
+SEARCH_QUALIFIERS = 'linked:pr'
+# GitHub returns at most 1000 results per search, so larger result sets are split by closing date
+SEARCH_RESULT_CAP = 1000
+SEARCH_START = date(2008, 1, 1)  # Before the first GitHub issue
+# Checkpoint cursor of a repository whose search was interrupted; it is searched again from the start
+SEARCH_CURSOR = 'search'
+
+# Metadata of one repository for the pre-pass (see get_repository_metadata)
+REPOSITORY_METADATA = """
+          r{index}: repository(owner: {owner}, name: {repo}) {{
+            isFork
+            isArchived
+            hasIssuesEnabled
+            issues(states: CLOSED) {{
+              totalCount
             }}
+          }}"""
+
+# Kinds of repositories the pre-pass skips besides the ones without closed issues
+PREPASS_SKIP = ['fork', 'archived']
+
+RATE_LIMIT = """
+          rateLimit {
+            cost
+            limit
+            remaining
+            resetAt
+          }"""
+
+class PageSizeController:
+    """
+    Chooses the number of issues per page of each repository.
+
+    Pages of heavy repositories (many issues with nested timeline items) can make GitHub time out,
+    so the page of a repository is halved after a timeout and grown back by a quarter after fast
+    responses, up to the GraphQL maximum of 100 but below the smallest size that timed out.
+    Pages that are slow but succeed (close to GitHub's 10 second limit) shrink it by a quarter.
+    """
+
+    def __init__(self, max_size=100, min_size=5, fast=2.0, slow=8.0):
+        self.max_size = max_size
+        self.min_size = min_size
+        self.fast = fast
+        self.slow = slow
+        self.sizes = {}
+        self.ceilings = {}  # Smallest page size that timed out, per repository
+        self.latency = {}  # Moving average of the page latency in seconds, per repository
+        self._lock = threading.Lock()
+
+    def size(self, key):
+        return self.sizes.get(key, self.max_size)
+
+    def success(self, key, seconds):
+        with self._lock:
+            latency = self.latency[key] = 0.7 * self.latency.get(key, seconds) + 0.3 * seconds
+            size = self.size(key)
+            if latency < self.fast:
+                size = min(self.ceilings.get(key, self.max_size + 1) - 1, size + max(size // 4, 1))
+            elif latency > self.slow:
+                size = max(self.min_size, size * 3 // 4)
+            self.sizes[key] = size
+
+    def shrink(self, key):
+        # Returns False if the page is already at its minimum size
+        with self._lock:
+            size = self.size(key)
+            if size <= self.min_size:
+                return False
+            self.ceilings[key] = min(self.ceilings.get(key, size), size)
+            self.sizes[key] = max(self.min_size, size // 2)
+            return True
+
+def is_timeout(result):
+    # GitHub reports a query that ran too long as "Something went wrong while executing your query.
+    # This may be the result of a timeout, ..." (or as a 502, see get_repo_issues)
+    messages = " ".join(str(error.get('message', '')) for error in result.get('errors') or []).lower()
+    return 'timeout' in messages or 'something went wrong' in messages
+
+def issues_connection(cursor, since, profile, first=100):
+    # Only issues updated after `since` are requested, for incremental harvests
+    issue_filter = ""
+    if since is not None:
+        issue_filter = ", filterBy: {{since: {since}}}".format(since=json.dumps(since))
+    fields = "".join("\n                  " + field for field in QUERY_PROFILES[profile])
+    return ISSUES_CONNECTION.format(first=first, cursor=json.dumps(cursor), filter=issue_filter, fields=fields)
+
+def get_repo_issues(owner, repo, client, cursor=None, on_page=None, since=None, profile='urls-only', pages=None):
+    """
+    Fetches all the closed issues of a repository, one page of (up to) 100 issues per GraphQL query.
+
+    Parameters:
+    - cursor (str): The cursor to start from, e.g. when the first page was already fetched by a
+      batched query or when resuming an interrupted harvest.
+    - on_page (callable): Called as on_page(owner, repo, issues, cursor) after every page with the
+      issues of the page and the cursor of the next page (None after the last page).
+    - since (str): If given, only issues updated after this ISO 8601 timestamp are fetched.
+    - profile (str): The query profile, i.e. which issue fields are fetched (see QUERY_PROFILES).
+    - pages (PageSizeController): Chooses the page size; shared by the workers of a harvest.
+    """
+    issues = []
+    pages = pages or PageSizeController()
+    key = f"{owner}/{repo}"
+
+    while True:
+        # GraphQL query. Using triple quotes for multi-line string
+        query = """
+        {{{rate_limit}
+          repository(owner: {owner}, name: {repo}) {{{issues}
           }}
         }}
-        """.format(owner=owner, repo=repo, cursor=json.dumps(cursor))
-        request = requests.post('https://api.github.com/graphql', json={'query': query}, headers=headers)
-        result = request.json()
-        # if "errors" in result:
-        #   return "Stop", "Stop"
-        # Handle rate limits
-        rate_limit = result['data']['rateLimit']
-        remaining = rate_limit['remaining']  # Remaining limit
-        resetAt = rate_limit['resetAt']  # Time when the limit will reset
-        if remaining < 1:  # Check if the remaining limit is less than 100
-          reset_time_utc = datetime.fromisoformat(resetAt[:-1]).replace(tzinfo=timezone.utc)
-          current_time_utc = datetime.now(timezone.utc)
-          wait_time = (reset_time_utc - current_time_utc).total_seconds() + 1
-
-          if wait_time > 0:  # If the reset time is in the future, sleep until reset
-              print(f"Rate limit low. Waiting for {wait_time} seconds until rate limit reset.")
-              time.sleep(wait_time)  # Sleep until the rate limit resets
+        """.format(rate_limit=RATE_LIMIT, owner=json.dumps(owner), repo=json.dumps(repo),
+                   issues=issues_connection(cursor, since, profile, pages.size(key)))
+        # Pacing, rate limit waits and retries are handled by the client. A page that keeps
+        # failing is retried only once at the same size, since a smaller page is more likely to pass.
+        start = time.perf_counter()
+        try:
+            result = client.graphql(query, max_retries=1)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code < 500:
+                raise
+            result = {'errors': [{'message': f"timeout ({e})"}]}
         # Extract data from response
-        if 'data' in result and 'repository' in result['data'] and result['data']['repository'] and 'issues' in result['data']['repository']:
-            for edge in result['data']['repository']['issues']['edges']:
-                issues.append(edge['node'])
+        if 'data' in result and result['data'] and 'repository' in result['data'] and result['data']['repository'] and 'issues' in result['data']['repository']:
+            pages.success(key, time.perf_counter() - start)
+            page = [edge['node'] for edge in result['data']['repository']['issues']['edges']]
+            issues.extend(page)
   
             # Check for more pages
             if result['data']['repository']['issues']['pageInfo']['hasNextPage']:
                 cursor = result['data']['repository']['issues']['pageInfo']['endCursor']
             else:
+                cursor = None
+            if on_page:
+                on_page(owner, repo, page, cursor)
+            if cursor is None:
                 break
+        elif is_timeout(result) and pages.shrink(key):
+            print(f"Query for {key} timed out. Retrying with pages of {pages.size(key)} issues.")
         else:
             raise Exception(f"Error fetching issues for {owner}/{repo}: {result.get('errors')}")
     return issues
 
+def get_batch_issues(repositories, client, on_page=None, since=None, profile='urls-only', pages=None):
+    """
+    Fetches the closed issues of several repositories, packing the first page of every
+    repository into a single aliased GraphQL query. Only the repositories whose first page
+    reports `hasNextPage` are then paginated one by one.
+
+    Parameters:
+    - repositories (list): A list of (owner, repo) tuples.
+    - client (GitHubClient): The client used to send the queries.
+    - on_page (callable): Called after every page, see get_repo_issues.
+    - since (dict): Optionally maps (owner, repo) tuples to the timestamp after which issues were updated.
+    - profile (str): The query profile, see get_repo_issues.
+    - pages (PageSizeController): Chooses the page size of the paginated repositories, see get_repo_issues.
+    Returns:
+    - dict: Maps each (owner, repo) tuple to its list of issues. Repositories that could not be
+      fetched (e.g. deleted or renamed ones) are reported and left out.
+    """
+    batch_issues = {}
+    since = since or {}
+    if len(repositories) > 1:
+        aliases = "".join("""
+          r{index}: repository(owner: {owner}, name: {repo}) {{{issues}
+          }}""".format(index=index, owner=json.dumps(owner), repo=json.dumps(repo),
+                         issues=issues_connection(None, since.get((owner, repo)), profile))
+            for index, (owner, repo) in enumerate(repositories))
+        query = "\n        {{{rate_limit}{aliases}\n        }}\n        ".format(rate_limit=RATE_LIMIT, aliases=aliases)
+        try:
+            result = client.graphql(query, max_retries=1)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code < 500:
+                raise
+            result = {}
+    else:
+        result = {}
+    if not result.get('data'):
+        # A single repository, or the whole document failed (e.g. a timeout): one query per repository
+        for owner, repo in repositories:
+            try:
+                batch_issues[(owner, repo)] = get_repo_issues(owner, repo, client, on_page=on_page,
+                                                              since=since.get((owner, repo)), profile=profile,
+                                                              pages=pages)
+            except Exception as e:
+                print(f"Skipping {owner}/{repo}: {e}")
+        return batch_issues
+
+    for index, (owner, repo) in enumerate(repositories):
+        # Missing repositories resolve to null and only report an error for their own alias
+        repository = result['data'].get(f'r{index}')
+        if not repository or not repository.get('issues'):
+            print(f"Skipping {owner}/{repo}: repository not found")
+            continue
+        issues = [edge['node'] for edge in repository['issues']['edges']]
+        page_info = repository['issues']['pageInfo']
+        cursor = page_info['endCursor'] if page_info['hasNextPage'] else None
+        if on_page:
+            on_page(owner, repo, issues, cursor)
+        if cursor:
+            try:
+                issues += get_repo_issues(owner, repo, client, cursor=cursor, on_page=on_page,
+                                          since=since.get((owner, repo)), profile=profile, pages=pages)
+            except Exception as e:
+                print(f"Skipping {owner}/{repo}: {e}")
+                continue
+        batch_issues[(owner, repo)] = issues
+    return batch_issues
+
+def search_issues(client, search, cursor=None, profile='urls-only'):
+    # Returns one page of search results (the `search` object of the response)
+    fields = "".join("\n                  " + field for field in QUERY_PROFILES[profile])
+    query = "\n        {{{rate_limit}{search}\n        }}\n        ".format(
+        rate_limit=RATE_LIMIT,
+        search=SEARCH_CONNECTION.format(query=json.dumps(search), first=100, cursor=json.dumps(cursor), fields=fields))
+    result = client.graphql(query)
+    if not result.get('data') or not result['data'].get('search'):
+        raise Exception(f"Error searching issues with '{search}': {result.get('errors')}")
+    return result['data']['search']
+
+def get_repo_issues_by_search(owner, repo, client, on_page=None, since=None, profile='urls-only',
+                              qualifiers=SEARCH_QUALIFIERS):
+    """
+    Fetches the candidate bugs of a repository through the GitHub issue search, which filters the
+    closed issues on the server (with the given search qualifiers, e.g. `linked:pr`) instead of
+    transferring every closed issue. Result sets over the search cap of 1000 issues are split into
+    closing date windows, halving each window until it fits.
+
+    Parameters:
+    - on_page (callable): Called after every page, see get_repo_issues. The cursor of the pages
+      before the last one is SEARCH_CURSOR.
+    - since (str): If given, only issues updated after this ISO 8601 timestamp are fetched.
+    - profile (str): The query profile, see get_repo_issues.
+    - qualifiers (str): Additional search qualifiers selecting the candidate bugs.
+    """
+    issues = []
+    base = f"repo:{owner}/{repo} is:issue is:closed {qualifiers}".strip()
+    if since is not None:
+        base += f" updated:>={since}"
+    # Windows of closing dates still to search; None is the whole history
+    windows = [None]
+    while windows:
+        window = windows.pop()
+        search = base if window is None else f"{base} closed:{window[0].isoformat()}..{window[1].isoformat()}"
+        page = search_issues(client, search, profile=profile)
+        if page['issueCount'] > SEARCH_RESULT_CAP:
+            start, end = window or (SEARCH_START, date.today() + timedelta(days=1))
+            if start < end:
+                middle = start + (end - start) // 2
+                # Searched in chronological order, as the windows are popped from the end
+                windows += [(middle + timedelta(days=1), end), (start, middle)]
+                continue
+            print(f"{owner}/{repo}: more than {SEARCH_RESULT_CAP} issues closed on {start}, some are missed")
+        while True:
+            found = [edge['node'] for edge in page['edges'] if edge['node']]
+            issues.extend(found)
+            last_page = not page['pageInfo']['hasNextPage']
+            if on_page:
+                on_page(owner, repo, found, None if last_page and not windows else SEARCH_CURSOR)
+            if last_page:
+                break
+            page = search_issues(client, search, cursor=page['pageInfo']['endCursor'], profile=profile)
+    return issues
+
+def get_repository_metadata(repositories, client, batch_size=200):
+    """
+    Fetches whether each repository is a fork, is archived and has issues enabled, and its number
+    of closed issues, with batch_size repositories per aliased GraphQL query.
+
+    Returns:
+    - dict: Maps (owner, repo) tuples to the `repository` objects of the response, or to None for
+      repositories that do not exist. Repositories of a failed query are left out.
+    """
+    metadata = {}
+    for start in range(0, len(repositories), batch_size):
+        batch = repositories[start:start + batch_size]
+        aliases = "".join(REPOSITORY_METADATA.format(index=index, owner=json.dumps(owner), repo=json.dumps(repo))
+                          for index, (owner, repo) in enumerate(batch))
+        query = "\n        {{{rate_limit}{aliases}\n        }}\n        ".format(rate_limit=RATE_LIMIT, aliases=aliases)
+        try:
+            result = client.graphql(query)
+        except requests.HTTPError as e:
+            # e.g. the query kept timing out; its repositories are harvested without pruning
+            result = {'errors': [{'message': str(e)}]}
+        if not result.get('data'):
+            print(f"Error fetching repository metadata: {result.get('errors')}")
+            continue
+        for index, repository in enumerate(batch):
+            metadata[repository] = result['data'].get(f'r{index}')
+    return metadata
+
+def prune_repositories(repositories, metadata, skip=PREPASS_SKIP):
+    """
+    Drops the repositories that cannot yield bugs according to their metadata (missing ones, ones
+    with issues disabled or without closed issues, and forks and archived ones if listed in skip),
+    and orders the rest by their number of closed issues, largest first, so that the largest
+    repositories start early instead of becoming the tail of the harvest. Repositories without
+    metadata are kept, at the end.
+
+    Returns:
+    - tuple: The remaining repositories and a dict with the number of repositories skipped per reason.
+    """
+    skipped = {'missing': 0, 'fork': 0, 'archived': 0, 'issues disabled': 0, 'no closed issues': 0}
+    remaining = []
+    for repository in repositories:
+        if repository not in metadata:
+            remaining.append(repository)
+            continue
+        info = metadata[repository]
+        if info is None:
+            reason = 'missing'
+        elif 'fork' in skip and info['isFork']:
+            reason = 'fork'
+        elif 'archived' in skip and info['isArchived']:
+            reason = 'archived'
+        elif not info['hasIssuesEnabled'] and not info['issues']['totalCount']:
+            reason = 'issues disabled'
+        elif not info['issues']['totalCount']:
+            reason = 'no closed issues'
+        else:
+            remaining.append(repository)
+            continue
+        skipped[reason] += 1
+    remaining.sort(key=lambda repository: -closed_issue_count(metadata, repository))
+    return remaining, skipped
+
+def closed_issue_count(metadata, repository):
+    # -1 for repositories without metadata
+    info = metadata.get(repository)
+    return info['issues']['totalCount'] if info else -1
+
 def contains_code_block(string):
     # Patterns for inline code and code blocks
     patterns = [
@@ -113,62 +426,177 @@ def contains_code_block(string):
             return True
     return False
 
-def main(input_csv, output_csv, token):
-  headers = {
-      'Authorization': f'Bearer {token}',
-      'Content-Type': 'application/json'
-  }
-  processed_urls = set()
-  count = 0
+def get_closer_type(issue):
+    closed_by = "Unknown"
+    if issue['timelineItems']['edges']:
+        closed_by_type = issue['timelineItems']['edges'][0]['node']['__typename']
+        if closed_by_type == 'ClosedEvent':
+            closer = issue['timelineItems']['edges'][0]['node']['closer']
+            if closer:
+                closed_by = closer['__typename']
+    return closed_by
+
+def read_repositories(input_csv, source=None):
+  # Different URLs of the same repository (e.g. with .git, a trailing slash, /tree/master,
+  # SSH form, other case) are harvested only once
+  repositories = []
+  processed_names = set()
+  duplicates = 0
+  for repo_url in read_repository_urls(input_csv, source):
+      owner, repo = parse_github_url(repo_url)
+      if not owner:
+          # print("Error", repo_url)
+          continue
+      if canonical_name(owner, repo) in processed_names:
+          duplicates += 1
+          continue
+      processed_names.add(canonical_name(owner, repo))
+      repositories.append((owner, repo))
+  if duplicates:
+      print(f"Skipping {duplicates} duplicate repository URLs")
+  return repositories
+
+class IssueWriter:
+    """
+    Writes the fix-closed issues of every harvested page to the output CSV and records the page
+    in the checkpoint. Pages arrive from several worker threads, hence the lock.
+    Finished repositories get the start time of the run as their high-water mark.
+    """
+
+    def __init__(self, outfile, checkpoint, seen_urls, marks):
+        self.writer = csv.writer(outfile)
+        self.outfile = outfile
+        self.checkpoint = checkpoint
+        # URLs already in the output, so that a page fetched again after a crash is not duplicated
+        self.seen_urls = seen_urls
+        self.marks = marks
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def write_page(self, owner, repo, issues, cursor):
+        with self._lock:
+            for issue in issues:
+                closed_by = get_closer_type(issue)
+                # contains_code = contains_code_block(issue['body'])
+                if (closed_by == "PullRequest" or closed_by == "Commit") and issue['url'] not in self.seen_urls:
+                    self.seen_urls.add(issue['url'])
+                    self.count+=1
+                    self.writer.writerow([issue['url']])
+            # The rows must be on disk before the checkpoint moves past their page
+            self.outfile.flush()
+        key = f"{owner}/{repo}"
+        if cursor:
+            self.checkpoint.save_cursor(key, cursor)
+        else:
+            self.checkpoint.mark_processed(key)
+            self.marks.update(key, self.checkpoint.started)
 
-  with open(input_csv, mode='r') as infile:
+def read_issue_urls(output_csv):
+  with open(output_csv, mode='r') as infile:
       reader = csv.reader(infile)
       next(reader, None)  # Skip header
+      return {row[0] for row in reader if row}
 
-      with open(output_csv, mode='w', newline='') as outfile:
-          writer = csv.writer(outfile)
-          writer.writerow(["Issue URL"])
+def main(input_csv, output_csv, tokens, workers=1, batch_size=1, checkpoint_path=None, resume=False,
+         incremental=False, profile='urls-only', session=None, mode='issues', qualifiers=SEARCH_QUALIFIERS,
+         prepass=False, prepass_skip=PREPASS_SKIP, burst=0.1, source=None):
+  # All workers share one connection pool and one pool of tokens with their rate limit budgets
+  client = GitHubClient(tokens, session=session or make_session(pool_size=workers), burst=burst)
+  checkpoint = Checkpoint(checkpoint_path or output_csv + '.checkpoint', resume=resume)
+  # Time of the last complete harvest of every repository, kept across runs. A search only sees the
+  # issues its qualifiers match, so search mode keeps marks of its own: an incremental run in
+  # issues mode must still collect the older issues the search left out
+  marks = HighWaterMarks(output_csv + ('.search.marks' if mode == 'search' else '.marks'))
+  # Resumed and incremental runs merge their rows into the existing output
+  append = (resume or incremental) and os.path.exists(output_csv)
+  # Page sizes adapt to the latency and timeouts of every repository
+  pages = PageSizeController()
+  seen_urls = read_issue_urls(output_csv) if append else set()
 
-          for row in reader:
-            # Assuming the second column contains the GitHub URL in the input CSV
-            if (len(row)) == 2:
-              repo_url = row[1]
-            else:
-              repo_url = row[0]
-            if repo_url in processed_urls:
-                # print(f"Skipping duplicate repo: {repo_url}")
-                continue
+  repositories = [(owner, repo) for owner, repo in read_repositories(input_csv, source)
+                  if not checkpoint.is_processed(f"{owner}/{repo}")]
+  # Repositories interrupted in the middle continue from their last cursor
+  in_progress = [(owner, repo) for owner, repo in repositories if checkpoint.get_cursor(f"{owner}/{repo}")]
+  pending = [(owner, repo) for owner, repo in repositories if not checkpoint.get_cursor(f"{owner}/{repo}")]
+  def resume_cursor(owner, repo):
+      # Repositories interrupted in search mode start over
+      cursor = checkpoint.get_cursor(f"{owner}/{repo}")
+      return None if cursor == SEARCH_CURSOR else cursor
+  large = []
+  if prepass:
+      metadata = get_repository_metadata(pending, client)
+      pending, skipped = prune_repositories(pending, metadata, prepass_skip)
+      print("Pre-pass skipped " + ", ".join(f"{count} {reason}" for reason, count in skipped.items()) + " repositories")
+      # Repositories with more than one page start first, on their own: batching them would only
+      # save their first query
+      large = [repository for repository in pending if closed_issue_count(metadata, repository) > 100]
+      pending = [repository for repository in pending if closed_issue_count(metadata, repository) <= 100]
+  # Small repositories are packed into aliased queries of batch_size repositories each
+  batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+  since = {}
+  if incremental:
+      since = {(owner, repo): marks.get(f"{owner}/{repo}") for owner, repo in repositories
+               if marks.get(f"{owner}/{repo}")}
 
-            processed_urls.add(repo_url) 
-            owner, repo = parse_github_url(repo_url)
+  with open(output_csv, mode='a' if append else 'w', newline='') as outfile:
+      issue_writer = IssueWriter(outfile, checkpoint, seen_urls, marks)
+      if not append:
+          issue_writer.writer.writerow(["Issue URL"])
+
+      # Progress is counted in repositories
+      metrics = metrics_of(client.session)
+      metrics.expect(len(in_progress + large + pending))
+      with ThreadPoolExecutor(max_workers=workers) as executor:
+          if mode == 'search':
+              # Interrupted searches start over; rows found again are not duplicated in the output
+              futures = {executor.submit(get_repo_issues_by_search, owner, repo, client,
+                                         on_page=issue_writer.write_page, since=since.get((owner, repo)),
+                                         profile=profile, qualifiers=qualifiers): 1
+                         for owner, repo in in_progress + large + pending}
+          else:
+              futures = {executor.submit(get_repo_issues, owner, repo, client,
+                                         cursor=resume_cursor(owner, repo),
+                                         on_page=issue_writer.write_page, since=since.get((owner, repo)),
+                                         profile=profile, pages=pages): 1
+                         for owner, repo in in_progress + large}
+              futures.update({executor.submit(get_batch_issues, batch, client, on_page=issue_writer.write_page,
+                                              since=since, profile=profile, pages=pages): len(batch)
+                              for batch in batches})
+          # Rows are written page by page; failed repositories stay out of the checkpoint
+          # so that a --resume run retries them
+          for future in as_completed(futures):
             try:
-                issues = get_repo_issues(owner, repo, headers)
-                if issues:
-                    for issue in issues:
-                        closed_by = "Unknown"
-                        if issue['timelineItems']['edges']:
-                            closed_by_type = issue['timelineItems']['edges'][0]['node']['__typename']
-                            if closed_by_type == 'ClosedEvent':
-                                closer = issue['timelineItems']['edges'][0]['node']['closer']
-                                if closer:
-                                    closed_by = closer['__typename']
-                        # contains_code = contains_code_block(issue['body'])
-                        closed_at = issue['closedAt']
-                        # if contains_code:
-                        #     pprint.pprint(issue)
-                        # print(count, issue["url"], closed_by, contains_code)
-                        if (closed_by == "PullRequest" or closed_by == "Commit"):
-                            count+=1
-                            writer.writerow([issue['url']])
+                future.result()
             except Exception as e:
-                continue
+                print(f"Error: {e}")
+            metrics.done(futures[future])
+  checkpoint.close()
+  marks.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fetch closed issues from GitHub repositories.')
     parser.add_argument('input_csv', type=str, help='Input CSV file path containing GitHub repository URLs.')
     parser.add_argument('output_csv', type=str, help='Output CSV file path to save the issue URLs.')
-    parser.add_argument('gh_token', type=str, help='Your GitHub access token.')
+    parser.add_argument('gh_token', type=str, help='Your GitHub access token (or several comma-separated tokens).')
+    parser.add_argument('--tokens-file', type=str, default=None, help='File with additional GitHub access tokens, one per line.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of repositories harvested concurrently.')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of repositories packed into one GraphQL query (e.g. 10-30).')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Checkpoint file path (default: <output_csv>.checkpoint).')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted harvest from its checkpoint, appending to the output CSV.')
+    parser.add_argument('--profile', choices=QUERY_PROFILES.keys(), default='urls-only', help='Issue fields to fetch: urls-only (default), triage (adds the title) or full (adds the body).')
+    add_session_arguments(parser)
+    parser.add_argument('--incremental', action='store_true', help='Only fetch issues updated since the last harvest of each repository and merge them into the output CSV.')
+    parser.add_argument('--mode', choices=['issues', 'search'], default='issues', help='issues (default) pages through all closed issues; search only fetches the candidate bugs found by the GitHub issue search.')
+    parser.add_argument('--prepass', action='store_true', help='Fetch the metadata of all repositories first, skip the ones that cannot yield bugs and harvest the largest first.')
+    parser.add_argument('--prepass-skip', nargs='*', choices=PREPASS_SKIP, default=PREPASS_SKIP, help='Repositories skipped by the pre-pass besides the ones without closed issues (default: fork archived).')
+    parser.add_argument('--search-qualifiers', type=str, default=SEARCH_QUALIFIERS, help=f"Search qualifiers of the candidate bugs in search mode (default: '{SEARCH_QUALIFIERS}').")
+    parser.add_argument('--burst', type=float, default=0.1, help='Fraction of the rate limit that may be spent ahead of schedule before requests are paced (default: 0.1).')
+    parser.add_argument('--source', type=str, default=None, help='With an index written by repo_registry.py, only harvest the repositories of this input CSV (e.g. puppet_urls.csv).')
 
 
     args = parser.parse_args()
-    main(args.input_csv, args.output_csv, args.gh_token)
\ No newline at end of file
+    tokens = load_tokens(args.gh_token, args.tokens_file)
+    main(args.input_csv, args.output_csv, tokens, args.workers, args.batch_size,
+         args.checkpoint, args.resume, args.incremental, args.profile,
+         session_from_args(args, pool_size=args.workers), mode=args.mode, qualifiers=args.search_qualifiers,
+         prepass=args.prepass, prepass_skip=args.prepass_skip, burst=args.burst, source=args.source)
@@ -1,89 +1,56 @@
-import requests
-import time
-import pprint
-import json
-import csv
 import argparse
 
+from crawler import Crawler, OffsetPagination, Source, add_crawler_arguments
+from http_session import add_session_arguments, make_session, session_from_args
 
-# Function to fetch repository urls from Puppet Forge
-def fetch_puppet_forge_repo_urls():
-    # Base URL of the Puppet Forge API
-    base_url = 'https://forgeapi.puppet.com/v3/modules'
-    # Placeholder for the repositories' URLs
-    repo_info = [] 
-    # Pagination parameters
-    limit = 100  # number of results per request, 100 is currently the maximum
-    offset = 0   # offset for pagination, start with 0
-    headers = {
-        'User-Agent': 'ResearchProject/1.0'
-    }
-    counter = 0
-    while True:
-        # Update the request URL with the current offset
-        request_url = f"{base_url}?limit={limit}&offset={offset}"
-        # Send an HTTP request to the Puppet Forge API
-        response = requests.get(request_url, headers=headers)
-        
-        # Break the loop if the request was not successful
-        if response.status_code != 200:
-            # print(f"Failed to retrieve data: {response.status_code}")
-            break
-        
-        # Load the response data as JSON
-        data = response.json()
-        # Extract the repository URLs from the response data
-        flag = True
-        for module in data['results']:
-            try:
-                counter +=1
-                flag = False
-                # Add the repository URL to our list
-                # with open('data.json', 'w') as f:
-                #     json.dump(module, f, indent=2)
-                name = module['current_release']['metadata']['name']
-                source_url = None
-                if module['issues_url']:
-                    if "github.com" in module['issues_url']:
-                        source_url = module['issues_url'].split("/issues")[0]
-                if not source_url:
-                    source_url = module['current_release']['metadata']['source']
-                    if source_url == "UNKNOWN":
-                        source_url =  module['homepage_url']
-                repo_info.append((name, source_url))
-            except KeyError:
-                # If the 'source' key doesn't exist, skip this module
-                # print("Error", name)
-                continue
-        # if flag:
-        #     print(data)
-        #     break
-        # Check if we have reached the last page of the results
-        if data['pagination']["next"] is None:
-            break
-        else:
-            # Update the offset for the next request (paginate)
-            offset += limit
-            # Respect rate limits and avoid overwhelming the server
-            time.sleep(1)  # sleep for 1 second before making a new request
-    return repo_info
+# Base URL of the Puppet Forge API
+BASE_URL = 'https://forgeapi.puppet.com/v3/modules'
+HEADERS = {
+    'User-Agent': 'ResearchProject/1.0',
+    'Accept': 'application/json',
+}
+PAGE_SIZE = 100  # number of results per request, 100 is currently the maximum
+# Large release fields that are not used, left out of the responses
+EXCLUDED_FIELDS = 'readme changelog license reference tasks plans'
 
-def main(output):
-    repository_info = fetch_puppet_forge_repo_urls()
 
-    # Write the data to a CSV file
-    with open(output, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        # Write the header
-        writer.writerow(['Name', 'Source URL'])
-        # Write the project data
-        for info in repository_info:
-            writer.writerow(info)
+def get_module_repo_info(module, crawler=None):
+    # Returns the (name, source URL) of a module, or None if its metadata is incomplete
+    try:
+        name = module['current_release']['metadata']['name']
+        source_url = None
+        if module['issues_url']:
+            if "github.com" in module['issues_url']:
+                source_url = module['issues_url'].split("/issues")[0]
+        if not source_url:
+            source_url = module['current_release']['metadata']['source']
+            if source_url == "UNKNOWN":
+                source_url =  module['homepage_url']
+        return name, source_url
+    except KeyError:
+        # If the 'source' key doesn't exist, skip this module
+        # print("Error", name)
+        return None
+
+SOURCE = Source(
+    'puppet-forge',
+    OffsetPagination(BASE_URL, items=lambda page: page['results'], total=lambda page: page['pagination']['total'],
+                     page_size=PAGE_SIZE, params={'exclude_fields': EXCLUDED_FIELDS}),
+    header=['Name', 'Source URL'],
+    row=get_module_repo_info,
+)
+
+def main(output, session=None, workers=8, rate=10, resume=False):
+    # Write the data to a CSV file, page by page
+    crawler = Crawler(session or make_session(pool_size=workers), workers, rate, headers=HEADERS)
+    crawler.run(SOURCE, output, resume)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Fetch GitHub repositories of Puppet Modules.')
     parser.add_argument('output_csv', type=str, help='Output CSV file path to save the repository URLs.')
+    add_crawler_arguments(parser)
+    add_session_arguments(parser)
     args = parser.parse_args()
 
-    main(args.output_csv)
\ No newline at end of file
+    main(args.output_csv, session_from_args(args, pool_size=args.workers), args.workers, args.rate, args.resume)
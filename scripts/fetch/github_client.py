@@ -0,0 +1,183 @@
+import os
+import time
+
+import requests
+
+from http_session import make_session
+from metrics import metrics_of
+from ratelimit import TokenPool, backoff_delay, parse_reset_time
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# Transient server errors that are retried with backoff
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def load_tokens(token=None, tokens_file=None):
+    """
+    Collects the GitHub access tokens to use.
+
+    Parameters:
+    - token (str): A token, or several comma-separated tokens (e.g. the `gh_token` argument).
+    - tokens_file (str): A file with one token per line.
+    Returns:
+    - list: The tokens, including the comma-separated ones of the GH_TOKENS environment variable,
+      without duplicates.
+    """
+    tokens = []
+    if token:
+        tokens += token.split(',')
+    if tokens_file:
+        with open(tokens_file) as file:
+            tokens += [line for line in file.read().splitlines() if not line.startswith('#')]
+    tokens += os.environ.get('GH_TOKENS', '').split(',')
+    return list(dict.fromkeys(token.strip() for token in tokens if token.strip()))
+
+
+class GitHubClient:
+    """
+    Sends GitHub API requests over a pooled session, routing every request to the token of the
+    pool with the most rate limit budget left, so that it can be used from several worker threads
+    at the same time.
+
+    Rate limits are handled here for every caller: an exhausted primary limit waits for the reset
+    (or moves to another token), a `Retry-After` header or a secondary rate limit blocks the token
+    for the requested time (or a jittered exponential backoff of at least a minute), and transient
+    errors (5xx responses, connection errors) are retried up to max_retries times with jittered
+    exponential backoff. Requests are paced once more than a burst fraction of the rate limit is
+    spent ahead of schedule (see RateLimitBudget).
+    """
+
+    def __init__(self, tokens, session=None, pool=None, max_retries=5, burst=0.1):
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        self.session = session if session is not None else make_session()
+        self.pool = pool if pool is not None else TokenPool(tokens, burst=burst)
+        self.max_retries = max_retries
+
+    def _headers(self, token):
+        return {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+
+    def _update_from_headers(self, token, response, resource):
+        if getattr(response, 'from_cache', False):
+            # A replayed response cost nothing and carries outdated rate limit figures
+            self.pool.refund(token, resource)
+            return
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        limit = response.headers.get('X-RateLimit-Limit')
+        if remaining is not None and reset is not None:
+            resource = response.headers.get('X-RateLimit-Resource', resource)
+            self.pool.update(token, int(remaining), int(reset), resource, limit=int(limit) if limit else None)
+
+    def _rate_limit_error(self, response):
+        """
+        Classifies a response as a 'primary' or a 'secondary' rate limit error, or None.
+        """
+        if response.status_code == 200:
+            # GraphQL reports an exhausted budget in the body of a 200 response
+            if b'RATE_LIMITED' in response.content:
+                errors = response.json().get('errors') or []
+                if any(error.get('type') == 'RATE_LIMITED' for error in errors):
+                    return 'primary'
+            return None
+        if response.status_code not in (403, 429):
+            return None
+        try:
+            message = str(response.json().get('message', '')).lower()
+        except (ValueError, AttributeError):
+            message = ''
+        if 'Retry-After' in response.headers or 'secondary rate limit' in message or 'abuse' in message:
+            return 'secondary'
+        if response.headers.get('X-RateLimit-Remaining') == '0' or 'rate limit' in message:
+            return 'primary'
+        return None  # e.g. a resource the token has no access to
+
+    def _request(self, method, url, resource, max_retries=None, **kwargs):
+        """
+        Sends a request with the token of the pool that has the most budget left, waiting out rate
+        limits and retrying transient errors (max_retries times, by default the client's).
+
+        Returns:
+        - tuple: The token used and the response.
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        while True:
+            token = self.pool.acquire(resource)
+            try:
+                response = self.session.request(method, url, headers=self._headers(token), **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.pool.refund(token, resource)
+                if attempt >= max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"GitHub API request failed ({e}). Retrying in {delay:.1f} seconds.")
+                time.sleep(delay)
+                metrics_of(self.session).retry(url)
+                attempt += 1
+                continue
+            self._update_from_headers(token, response, resource)
+            # A replayed response would come back the same, so it is never retried
+            error = None if getattr(response, 'from_cache', False) else self._rate_limit_error(response)
+            if error == 'secondary':
+                retry_after = response.headers.get('Retry-After')
+                if retry_after is not None and retry_after.isdigit():
+                    delay = int(retry_after)
+                else:
+                    # GitHub asks to wait at least a minute, then increasingly longer
+                    delay = 60 + backoff_delay(attempt, base=60, cap=900)
+                self.pool.block(token, delay, resource)
+            elif error == 'primary':
+                reset = response.headers.get('X-RateLimit-Reset')
+                if reset is not None:
+                    # The next acquire waits for the reset, or picks another token of the pool
+                    self.pool.update(token, 0, int(reset), resource)
+                else:
+                    self.pool.block(token, 60 + backoff_delay(attempt, base=60, cap=900), resource)
+            elif response.status_code in RETRY_STATUSES and attempt < max_retries \
+                    and not getattr(response, 'from_cache', False):
+                delay = backoff_delay(attempt)
+                print(f"GitHub API error {response.status_code}. Retrying in {delay:.1f} seconds.")
+                time.sleep(delay)
+            else:
+                return token, response
+            metrics_of(self.session).retry(url)
+            attempt += 1
+
+    def graphql(self, query, variables=None, max_retries=None):
+        """
+        Sends a GraphQL query and returns the decoded JSON response.
+        The `rateLimit` block of the response (if requested by the query) and the rate limit
+        headers update the budget of the token that was used.
+        Raises requests.HTTPError if the query still fails after max_retries retries (by default
+        the client's; callers that can make the query lighter pass fewer).
+        """
+        payload = {'query': query}
+        if variables:
+            payload['variables'] = variables
+        token, response = self._request('POST', GRAPHQL_URL, 'graphql', max_retries=max_retries, json=payload)
+        try:
+            result = response.json()
+        except ValueError:
+            # e.g. the HTML body of a 502
+            response.raise_for_status()
+            raise
+        if not isinstance(result, dict) or (response.status_code >= 400 and 'errors' not in result):
+            response.raise_for_status()
+        rate_limit = (result.get('data') or {}).get('rateLimit')
+        if rate_limit and not getattr(response, 'from_cache', False):
+            self.pool.update(token, rate_limit['remaining'], parse_reset_time(rate_limit['resetAt']), 'graphql',
+                             limit=rate_limit.get('limit'), cost=rate_limit.get('cost'))
+        return result
+
+    def get(self, url, params=None):
+        """
+        Sends a REST API GET request and returns the response.
+        """
+        token, response = self._request('GET', url, 'core', params=params)
+        return response
@@ -0,0 +1,163 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Responses of these URLs never change, so they are replayed without ever asking the server again
+IMMUTABLE_PATTERNS = [
+    re.compile(r"/repos/[^/]+/[^/]+/commits/[0-9a-f]{40}$"),  # GitHub commit details by SHA
+    re.compile(r"/versions/[^/?]+/?$"),  # Published Galaxy collection / Supermarket cookbook versions
+]
+
+
+def request_key(request):
+    """
+    Computes the cache key of a prepared request from its method, URL and body.
+    """
+    digest = hashlib.sha256(f"{request.method} {request.url}\n".encode())
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode()
+    digest.update(body)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    A persistent cache of HTTP responses, with one JSON file per response.
+
+    Entries older than the TTL are not discarded but revalidated (see CachingAdapter).
+    When the cache grows beyond max_entries, the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory, ttl=86400, max_entries=200000):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._entries = sum(len(files) for _, _, files in os.walk(directory))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        # The modification time doubles as the last access time for the LRU eviction
+        os.utime(path)
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_new = not os.path.exists(path)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, path)
+        if is_new:
+            with self._lock:
+                self._entries += 1
+                if self._entries > self.max_entries:
+                    self._evict()
+
+    def _evict(self):
+        # Called with the lock held; evicts down to 90% of the maximum in one pass
+        paths = [os.path.join(root, name) for root, _, files in os.walk(self.directory) for name in files]
+        paths.sort(key=lambda path: os.stat(path).st_mtime)
+        excess = len(paths) - int(self.max_entries * 0.9)
+        for path in paths[:max(excess, 0)]:
+            os.remove(path)
+        self._entries = len(paths) - max(excess, 0)
+
+
+def is_cacheable(response):
+    """
+    Whether a response can be stored: a 200 response, unless its JSON body reports errors
+    (e.g. a GraphQL query that was rate limited or timed out, which GitHub answers with a 200).
+    """
+    if response.status_code != 200:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return True
+    return not (isinstance(body, dict) and 'errors' in body)
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    A transport adapter that answers requests from a ResponseCache.
+
+    - Responses of immutable URLs (see IMMUTABLE_PATTERNS) are replayed forever.
+    - Other responses are replayed while they are younger than the cache TTL. Older ones are
+      revalidated with If-None-Match / If-Modified-Since, and a 304 answer (which does not count
+      against the GitHub rate limit) replays the cached body.
+    Only responses without errors are stored (see is_cacheable).
+    Replayed responses have `from_cache` set to True.
+    """
+
+    def __init__(self, cache, methods=('GET', 'POST'), **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.methods = methods
+
+    def _build_cached_response(self, request, entry):
+        response = Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = base64.b64decode(entry['content'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = entry['url']
+        response.reason = 'OK'
+        response.request = request
+        response.connection = self
+        response.from_cache = True
+        return response
+
+    def send(self, request, **kwargs):
+        if request.method not in self.methods:
+            return super().send(request, **kwargs)
+        key = request_key(request)
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry['immutable'] or time.time() - entry['stored_at'] < self.cache.ttl:
+                return self._build_cached_response(request, entry)
+            validators = {}
+            if entry['headers'].get('ETag'):
+                validators['If-None-Match'] = entry['headers']['ETag']
+            if entry['headers'].get('Last-Modified'):
+                validators['If-Modified-Since'] = entry['headers']['Last-Modified']
+            if validators:
+                request = request.copy()
+                request.headers.update(validators)
+
+        response = super().send(request, **kwargs)
+        response.from_cache = False
+        if response.status_code == 304 and entry is not None:
+            entry['stored_at'] = time.time()
+            self.cache.put(key, entry)
+            return self._build_cached_response(request, entry)
+        if is_cacheable(response):
+            self.cache.put(key, {
+                'url': response.url,
+                'status': response.status_code,
+                'headers': dict(response.headers),
+                'content': base64.b64encode(response.content).decode(),
+                'stored_at': time.time(),
+                'immutable': any(pattern.search(request.url.split('?')[0]) for pattern in IMMUTABLE_PATTERNS),
+            })
+        return response
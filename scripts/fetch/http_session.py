@@ -0,0 +1,106 @@
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from http_cache import CachingAdapter, ResponseCache
+from metrics import Metrics, MetricsAdapter, metrics_of
+from ratelimit import backoff_delay
+from replay import RecordingAdapter, ReplayAdapter
+
+
+def make_session(pool_size=10, cache=None, record=None, replay=None, metrics=None):
+    """
+    Creates a requests session whose connection pool can be shared by several worker threads.
+
+    Parameters:
+    - pool_size (int): The maximum number of pooled connections per host.
+    - cache (ResponseCache): If given, responses are stored in and replayed from this cache.
+    - record (str): If given, every request/response exchange is recorded to this archive.
+    - replay (ReplayAdapter): If given, responses are served from its archive instead of the network.
+    - metrics (Metrics): If given, every exchange is recorded in it (available as session.metrics).
+    Returns:
+    - requests.Session: The configured session.
+    """
+    session = requests.Session()
+    if replay is not None:
+        adapter = replay
+    elif cache is not None:
+        adapter = CachingAdapter(cache, pool_connections=pool_size, pool_maxsize=pool_size)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    if record is not None:
+        adapter = RecordingAdapter(adapter, record)
+    if metrics is not None:
+        adapter = MetricsAdapter(adapter, metrics)
+    session.metrics = metrics
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def add_session_arguments(parser):
+    """
+    Adds the command line options shared by every script that talks to a web API.
+    """
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory of a persistent HTTP response cache (disabled by default).')
+    parser.add_argument('--cache-ttl', type=int, default=86400, help='Seconds before a cached response is revalidated (default: one day).')
+    parser.add_argument('--cache-max-entries', type=int, default=200000, help='Maximum number of cached responses before the least recently used are evicted.')
+    parser.add_argument('--record', type=str, default=None, help='Record all the HTTP traffic to this archive (JSON lines, gzipped if it ends with .gz).')
+    parser.add_argument('--replay', type=str, default=None, help='Serve all the HTTP traffic from a recorded archive instead of the network.')
+    parser.add_argument('--replay-latency', type=float, default=0.0, help='Seconds of emulated latency per replayed response.')
+    parser.add_argument('--replay-rate-limit', type=int, default=None, help='Emulated number of requests allowed per hour when replaying.')
+    parser.add_argument('--metrics', type=str, default=None, help='Append snapshots of the request, latency, retry, rate limit and progress metrics to this file (JSON lines).')
+    parser.add_argument('--metrics-prom', type=str, default=None, help='Keep the latest metrics in this Prometheus textfile.')
+    parser.add_argument('--metrics-interval', type=float, default=30, help='Seconds between metrics snapshots (default: 30).')
+
+
+def session_from_args(args, pool_size=10):
+    """
+    Creates the session configured by the options of add_session_arguments.
+    """
+    cache = None
+    if args.cache_dir:
+        cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl, max_entries=args.cache_max_entries)
+    replay = None
+    if args.replay:
+        replay = ReplayAdapter(args.replay, latency=args.replay_latency, rate_limit=args.replay_rate_limit)
+    metrics = None
+    if args.metrics or args.metrics_prom:
+        metrics = Metrics(args.metrics, args.metrics_prom, args.metrics_interval).start()
+    return make_session(pool_size=pool_size, cache=cache, record=args.record, replay=replay, metrics=metrics)
+
+
+def get_json(session, url, params=None, headers=None, limiter=None, retries=3):
+    """
+    Sends a GET request to a registry API and returns the decoded JSON response, retrying failed
+    requests (error statuses, connection errors) with jittered exponential backoff.
+
+    Parameters:
+    - limiter (RequestRateLimiter): If given, every attempt waits for its turn.
+    - retries (int): The number of retries before giving up.
+    Returns:
+    - The decoded response, or None if it could not be retrieved (the error is printed).
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            response = session.get(url, params=params, headers=headers)
+            if response.status_code == 200:
+                return response.json()
+            error = response.status_code
+            if response.status_code == 404:
+                break
+            retry_after = response.headers.get('Retry-After')
+        except (requests.RequestException, ValueError) as e:
+            error = e
+            retry_after = None
+        if attempt < retries:
+            metrics_of(session).retry(url)
+            if retry_after is not None and retry_after.isdigit():
+                time.sleep(int(retry_after))
+            else:
+                time.sleep(backoff_delay(attempt))
+    print(f"Failed to retrieve {url} {params or ''}: {error}")
+    return None
@@ -0,0 +1,252 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from requests.adapters import BaseAdapter
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Variable path segments collapsed into one endpoint per API route
+ROUTES = [
+    (re.compile(r'^/repos/[^/]+/[^/]+'), '/repos/{owner}/{repo}'),
+    (re.compile(r'/(pulls|issues|commits)/[^/]+'), r'/\1/{id}'),
+    (re.compile(r'^/api/v1/cookbooks/[^/]+'), '/api/v1/cookbooks/{name}'),
+    (re.compile(r'/collections/index/[^/]+/[^/]+/versions/[^/]+'), '/collections/index/{namespace}/{name}/versions/{version}'),
+    (re.compile(r'/issue/[^/]+/'), '/issue/{key}/'),
+]
+
+
+def endpoint(url):
+    """
+    Returns the endpoint of a URL: its host and path, with the variable parts of the path
+    (repositories, issue numbers, cookbook names, ...) collapsed, e.g. api.github.com/repos/{owner}/{repo}/pulls/{id}.
+    """
+    parts = urlsplit(url)
+    path = parts.path.rstrip('/') or '/'
+    for pattern, replacement in ROUTES:
+        path = pattern.sub(replacement, path)
+    return parts.netloc + path
+
+
+class Metrics:
+    """
+    Collects the metrics of the network stages of a run: requests, response bytes, errors,
+    retries and a latency histogram per endpoint, the rate limit remaining per GitHub resource,
+    and the progress of the run (items done out of the expected ones, items per second, ETA).
+
+    Every interval seconds, and once more when the run ends, a snapshot is appended to a JSON
+    lines file (path) and/or written as a Prometheus textfile (prometheus), e.g. for the textfile
+    collector of the node exporter.
+    """
+
+    def __init__(self, path=None, prometheus=None, interval=30):
+        self.path = path
+        self.prometheus = prometheus
+        self.interval = interval
+        self.started = time.monotonic()
+        self.endpoints = {}
+        self.rate_limit_remaining = {}
+        self.items = 0
+        self.expected = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _endpoint(self, url):
+        name = endpoint(url)
+        if name not in self.endpoints:
+            self.endpoints[name] = {'requests': 0, 'bytes': 0, 'errors': 0, 'retries': 0,
+                                    'latency_sum': 0.0, 'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.endpoints[name]
+
+    def observe(self, url, seconds, response=None):
+        """
+        Records a request and its response (None if the request failed without one).
+        """
+        with self._lock:
+            stats = self._endpoint(url)
+            stats['requests'] += 1
+            stats['latency_sum'] += seconds
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            stats['latency_buckets'][bucket] += 1
+            if response is None or response.status_code >= 400:
+                stats['errors'] += 1
+            if response is not None:
+                stats['bytes'] += len(response.content)
+                remaining = response.headers.get('X-RateLimit-Remaining')
+                if remaining is not None and remaining.isdigit():
+                    resource = response.headers.get('X-RateLimit-Resource', 'core')
+                    self.rate_limit_remaining[resource] = int(remaining)
+
+    def retry(self, url):
+        # Records that a failed request to url is sent again
+        with self._lock:
+            self._endpoint(url)['retries'] += 1
+
+    def expect(self, count):
+        # Adds count items to the number of items the run is expected to process
+        with self._lock:
+            self.expected = (self.expected or 0) + count
+
+    def done(self, count=1):
+        # Records that count more items were processed
+        with self._lock:
+            self.items += count
+
+    def snapshot(self):
+        """
+        Returns:
+        - dict: The current metrics, with the latency histograms as cumulative bucket counts.
+        """
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            rate = self.items / elapsed if elapsed else 0.0
+            eta = None
+            if self.expected is not None and rate:
+                eta = max(self.expected - self.items, 0) / rate
+            endpoints = {}
+            for name, stats in self.endpoints.items():
+                cumulative, buckets = 0, {}
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats['latency_buckets']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                endpoints[name] = {key: stats[key] for key in ('requests', 'bytes', 'errors', 'retries')}
+                endpoints[name]['latency'] = {'sum': round(stats['latency_sum'], 3), 'buckets': buckets}
+            return {
+                'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'elapsed': round(elapsed, 1),
+                'requests': sum(stats['requests'] for stats in self.endpoints.values()),
+                'bytes': sum(stats['bytes'] for stats in self.endpoints.values()),
+                'errors': sum(stats['errors'] for stats in self.endpoints.values()),
+                'retries': sum(stats['retries'] for stats in self.endpoints.values()),
+                'rate_limit_remaining': dict(self.rate_limit_remaining),
+                'items': self.items,
+                'expected_items': self.expected,
+                'items_per_sec': round(rate, 3),
+                'eta_seconds': round(eta) if eta is not None else None,
+                'endpoints': endpoints,
+            }
+
+    def write(self):
+        # Appends a snapshot to the JSON lines file and replaces the Prometheus textfile
+        snapshot = self.snapshot()
+        if self.path:
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(snapshot) + '\n')
+        if self.prometheus:
+            # Written to a temporary file first, so that the collector never reads a partial file
+            with open(self.prometheus + '.tmp', 'w') as file:
+                file.write(prometheus_text(snapshot))
+            os.replace(self.prometheus + '.tmp', self.prometheus)
+
+    def start(self):
+        """
+        Writes a snapshot every interval seconds in the background, and a last one at exit.
+        """
+        def run():
+            while not self._stopped.wait(self.interval):
+                self.write()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        return self
+
+    def close(self):
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self.write()
+
+
+class NoMetrics:
+    """
+    Stands in for Metrics when a session has none, so that callers need not check.
+    """
+
+    def observe(self, url, seconds, response=None):
+        pass
+
+    def retry(self, url):
+        pass
+
+    def expect(self, count):
+        pass
+
+    def done(self, count=1):
+        pass
+
+
+NO_METRICS = NoMetrics()
+
+
+def metrics_of(session):
+    # The metrics of a session created by http_session.make_session, or NO_METRICS
+    return getattr(session, 'metrics', None) or NO_METRICS
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def prometheus_text(snapshot):
+    """
+    Returns a snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+
+    def metric(name, kind, samples):
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{_label(label)}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    endpoints = snapshot['endpoints']
+    for key in ('requests', 'bytes', 'errors', 'retries'):
+        metric(f"iac_http_{key}_total", 'counter',
+               [({'endpoint': name}, stats[key]) for name, stats in endpoints.items()])
+    lines.append("# TYPE iac_http_request_duration_seconds histogram")
+    for name, stats in endpoints.items():
+        lines += [f'iac_http_request_duration_seconds_bucket{{endpoint="{_label(name)}",le="{bound}"}} {count}'
+                  for bound, count in stats['latency']['buckets'].items()]
+    lines += [f'iac_http_request_duration_seconds_sum{{endpoint="{_label(name)}"}} {stats["latency"]["sum"]}'
+              for name, stats in endpoints.items()]
+    lines += [f'iac_http_request_duration_seconds_count{{endpoint="{_label(name)}"}} {stats["requests"]}'
+              for name, stats in endpoints.items()]
+    metric('iac_rate_limit_remaining', 'gauge',
+           [({'resource': resource}, remaining) for resource, remaining in snapshot['rate_limit_remaining'].items()])
+    metric('iac_items_total', 'counter', [({}, snapshot['items'])])
+    if snapshot['expected_items'] is not None:
+        metric('iac_items_expected', 'gauge', [({}, snapshot['expected_items'])])
+    metric('iac_items_per_second', 'gauge', [({}, snapshot['items_per_sec'])])
+    if snapshot['eta_seconds'] is not None:
+        metric('iac_eta_seconds', 'gauge', [({}, snapshot['eta_seconds'])])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsAdapter(BaseAdapter):
+    """
+    Transport adapter that records the latency, status and size of every exchange of the
+    adapter it wraps in a Metrics instance.
+    """
+
+    def __init__(self, adapter, metrics):
+        super().__init__()
+        self.adapter = adapter
+        self.metrics = metrics
+
+    def send(self, request, **kwargs):
+        started = time.monotonic()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except Exception:
+            self.metrics.observe(request.url, time.monotonic() - started)
+            raise
+        self.metrics.observe(request.url, time.monotonic() - started, response)
+        return response
+
+    def close(self):
+        self.adapter.close()
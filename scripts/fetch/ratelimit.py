@@ -0,0 +1,204 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+
+def parse_reset_time(reset_at):
+    """
+    Converts a GitHub `resetAt` timestamp (e.g. '2024-01-01T10:00:00Z') into epoch seconds.
+    """
+    if reset_at is None:
+        return None
+    reset_time_utc = datetime.fromisoformat(reset_at[:-1]).replace(tzinfo=timezone.utc)
+    return reset_time_utc.timestamp()
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """
+    Returns a jittered exponential backoff delay in seconds for the given retry attempt (0, 1, ...).
+    The delay is drawn uniformly up to base * 2^attempt (capped), so that threads and scripts that
+    fail at the same time do not retry in lockstep.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RequestRateLimiter:
+    """
+    Caps the requests of the threads sharing it to rate requests per second (no cap if rate is
+    None), spacing them evenly instead of sending them in bursts.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class RateLimitBudget:
+    """
+    Keeps track of the GitHub rate limit budget shared by all the threads of a harvest.
+
+    Every request reserves the average cost of the recent requests before it is sent, and the
+    real figures reported by GitHub (the `rateLimit` block of a GraphQL response or the
+    `X-RateLimit-*` headers) replace the estimate once the response arrives. When the budget is
+    drained, callers block until the reset time.
+
+    Requests are also paced: once more than a burst fraction of the limit is spent ahead of the
+    elapsed part of the window, requests are spread evenly over the rest of the window instead of
+    draining the budget and then stalling until the reset. A budget can also be blocked for a while, e.g. after a
+    secondary rate limit.
+    """
+
+    def __init__(self, remaining=5000, reset_at=None, window=3600, burst=0.1):
+        self.limit = remaining
+        self.remaining = remaining
+        self.reset_at = reset_at  # Epoch seconds
+        self.window = window  # Length of the rate limit window in seconds
+        self.burst = burst
+        self.cost = 1.0  # Moving average of the points spent per request
+        self.blocked_until = 0
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def available(self):
+        now = time.time()
+        if self.blocked_until > now:
+            return 0
+        # Once the reset time has passed the budget is full again, even before GitHub reports it
+        if self.reset_at and self.reset_at < now:
+            return self.limit
+        return self.remaining
+
+    def ready_at(self):
+        # The time at which the budget can be used again
+        if self.remaining >= 1 or not self.reset_at:
+            return self.blocked_until
+        return max(self.blocked_until, self.reset_at)
+
+    def _pace(self, now):
+        # Called with the lock held; returns the time at which the request may be sent
+        if not self.reset_at or self.reset_at <= now:
+            return now
+        time_left = self.reset_at - now
+        if self.remaining / self.limit >= time_left / self.window - self.burst:
+            # Within the burst allowance: small harvests still run at full speed
+            return now
+        interval = time_left / max(self.remaining / self.cost, 1)
+        slot = max(self._next_slot, now)
+        self._next_slot = slot + interval
+        return slot
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            if self.blocked_until > now:
+                wait_time = self.blocked_until - now
+                print(f"Secondary rate limit hit. Waiting for {wait_time:.0f} seconds.")
+                time.sleep(wait_time)
+                now = time.time()
+            if self.remaining < 1 and self.reset_at:
+                wait_time = self.reset_at - time.time() + 1
+                if wait_time > 0:  # If the reset time is in the future, sleep until reset
+                    print(f"Rate limit low. Waiting for {wait_time} seconds until rate limit reset.")
+                    # Sleeping while holding the lock keeps the other threads waiting as well.
+                    time.sleep(wait_time)
+                self.remaining = self.cost
+                now = time.time()
+            slot = self._pace(now)
+            self.remaining -= self.cost
+        if slot > now:
+            time.sleep(slot - now)
+
+    def refund(self):
+        # Gives back the points reserved for a request that never reached GitHub (e.g. a cached response)
+        with self._lock:
+            self.remaining = min(self.remaining + self.cost, self.limit)
+
+    def block(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+    def update(self, remaining, reset_time, limit=None, cost=None):
+        """
+        Records the rate limit figures reported by GitHub.
+
+        Parameters:
+        - remaining (int): The points left in the current window.
+        - reset_time (float): The end of the window in epoch seconds, see parse_reset_time for
+          GraphQL's `resetAt`.
+        - limit (int): The points per window, if reported.
+        - cost (int): The points the request cost, if reported (GraphQL's `rateLimit.cost`).
+        """
+        with self._lock:
+            if limit:
+                self.limit = limit
+            if cost is not None:
+                self.cost = 0.8 * self.cost + 0.2 * max(cost, 1)
+            if reset_time == self.reset_at:
+                # Responses of concurrent requests may arrive out of order within the same window.
+                self.remaining = min(self.remaining, remaining)
+            else:
+                self.remaining = remaining
+                self.reset_at = reset_time
+
+
+class TokenPool:
+    """
+    A pool of GitHub access tokens with one budget per token and rate limit resource
+    ('graphql', 'core'). Each request is routed to the token that has the most budget
+    left, so the caller only has to wait once every token is drained.
+    """
+
+    def __init__(self, tokens, burst=0.1):
+        if not tokens:
+            raise ValueError("At least one GitHub access token is required.")
+        self.tokens = list(tokens)
+        self.burst = burst  # Fraction of the limit spent ahead of schedule before pacing starts
+        self.budgets = {}
+        self._lock = threading.Lock()
+
+    def _budget(self, token, resource):
+        # Called with the lock held
+        if (token, resource) not in self.budgets:
+            self.budgets[(token, resource)] = RateLimitBudget(burst=self.burst)
+        return self.budgets[(token, resource)]
+
+    def acquire(self, resource='graphql'):
+        """
+        Reserves one request of the given resource and returns the token to send it with.
+        """
+        with self._lock:
+            budgets = [(token, self._budget(token, resource)) for token in self.tokens]
+            token, budget = max(budgets, key=lambda item: item[1].available())
+            if budget.available() < 1:
+                # Every token is drained or blocked: wait for the one that is ready first
+                token, budget = min(budgets, key=lambda item: item[1].ready_at())
+        budget.acquire()
+        return token
+
+    def update(self, token, remaining, reset_time, resource='graphql', limit=None, cost=None):
+        with self._lock:
+            budget = self._budget(token, resource)
+        budget.update(remaining, reset_time, limit, cost)
+
+    def block(self, token, seconds, resource='graphql'):
+        # Keeps the token from being used for the given resource for a while, e.g. after a secondary rate limit
+        with self._lock:
+            budget = self._budget(token, resource)
+        budget.block(seconds)
+
+    def refund(self, token, resource='graphql'):
+        with self._lock:
+            budget = self._budget(token, resource)
+        budget.refund()
@@ -0,0 +1,157 @@
+import atexit
+import base64
+import gzip
+import json
+import threading
+import time
+from collections import defaultdict
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from http_cache import request_key
+
+
+def open_archive(path, mode):
+    # Archives ending with .gz are compressed
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def build_response(request, status, headers, content, adapter):
+    response = Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = content
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = request.url
+    response.reason = 'OK' if status < 400 else 'Error'
+    response.request = request
+    response.connection = adapter
+    return response
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    A transport adapter that sends requests through another adapter and appends every exchange
+    (request method, URL and body; response status, headers and body) to a JSON-lines archive.
+    Request headers are not recorded, so archives never contain access tokens.
+    """
+
+    def __init__(self, adapter, path):
+        super().__init__()
+        self.adapter = adapter
+        self._lock = threading.Lock()
+        self._file = open_archive(path, 'w')
+        # Scripts do not close their sessions, and a compressed archive needs its trailer
+        atexit.register(self._file.close)
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode()
+        entry = {
+            'key': request_key(request),
+            'method': request.method,
+            'url': request.url,
+            'body': base64.b64encode(body).decode(),
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'content': base64.b64encode(response.content).decode(),
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+        return response
+
+    def close(self):
+        self.adapter.close()
+        self._file.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    A transport adapter that serves the responses of a recorded archive instead of the network,
+    so that the pipeline can run offline and deterministically.
+
+    Requests are matched by method, URL and body. If the same request was recorded several times
+    (e.g. a retry), its responses are served in the recorded order and the last one is repeated.
+    Unrecorded requests get a 404 response.
+
+    Parameters:
+    - latency (float): Seconds to wait before every response, to emulate the network.
+    - rate_limit (int): If given, only this many requests are served per rate limit window of
+      window seconds; further requests get a rate limit error like the real APIs return it
+      (403 with `X-RateLimit-Remaining: 0` for GitHub, 429 with `Retry-After` otherwise).
+    """
+
+    def __init__(self, path, latency=0.0, rate_limit=None, window=3600):
+        super().__init__()
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.responses = defaultdict(list)
+        self._served = defaultdict(int)
+        self._window_start = time.time()
+        self._window_requests = 0
+        self._lock = threading.Lock()
+        with open_archive(path, 'r') as archive:
+            for line in archive:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.responses[entry['key']].append(entry)
+
+    def _check_rate_limit(self, request):
+        # Returns the rate limit headers to add, and whether the request is over the limit
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.window:
+                self._window_start = now
+                self._window_requests = 0
+            self._window_requests += 1
+            remaining = self.rate_limit - self._window_requests
+            reset = int(self._window_start + self.window)
+        headers = {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(max(remaining, 0)),
+            'X-RateLimit-Reset': str(reset),
+        }
+        return headers, remaining < 0
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        rate_limit_headers = {}
+        if self.rate_limit is not None:
+            rate_limit_headers, exceeded = self._check_rate_limit(request)
+            if exceeded:
+                if 'api.github.com' in request.url:
+                    content = json.dumps({'message': 'API rate limit exceeded'}).encode()
+                    return build_response(request, 403, rate_limit_headers, content, self)
+                retry_after = int(rate_limit_headers['X-RateLimit-Reset']) - int(time.time())
+                headers = {'Retry-After': str(max(retry_after, 1))}
+                return build_response(request, 429, headers, b'', self)
+
+        key = request_key(request)
+        with self._lock:
+            entries = self.responses.get(key)
+            if not entries:
+                entry = None
+            else:
+                entry = entries[min(self._served[key], len(entries) - 1)]
+                self._served[key] += 1
+        if entry is None:
+            content = json.dumps({'message': f'No recorded response for {request.method} {request.url}'}).encode()
+            return build_response(request, 404, {'Content-Type': 'application/json'}, content, self)
+        headers = dict(entry['headers'])
+        headers.update(rate_limit_headers)
+        # The recorded body was already decoded by the transport
+        headers.pop('Content-Encoding', None)
+        return build_response(request, entry['status'], headers, base64.b64decode(entry['content']), self)
+
+    def close(self):
+        pass
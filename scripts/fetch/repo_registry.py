@@ -0,0 +1,172 @@
+import argparse
+import csv
+import json
+import os
+import re
+
+import requests
+
+from github_client import GitHubClient, load_tokens
+from http_session import add_session_arguments, session_from_args
+from metrics import metrics_of
+
+# Matches https://, http://, git://, ssh://git@ and git@host: forms of a GitHub repository URL,
+# ignoring anything after the repository name (e.g. /tree/master, /issues, a trailing slash)
+GITHUB_URL = re.compile(r"^(?:[\w+]+://)?(?:[^@/\s]+@)?(?:www\.)?github\.com[:/]+([^/\s]+)/([^/\s#?]+)", re.IGNORECASE)
+
+
+def parse_github_url(url):
+    """
+    Extracts the owner and the name of a GitHub repository from any form of its URL.
+    Returns (None, None) for URLs that do not point to a GitHub repository.
+    """
+    match = GITHUB_URL.match(url.strip())
+    if not match:
+        return None, None
+    owner, repo = match.groups()
+    if repo.endswith('.git'):
+        repo = repo[:-4]
+    if not repo:
+        return None, None
+    return owner, repo
+
+
+def canonical_name(owner, repo):
+    # GitHub owner and repository names are case-insensitive
+    return f"{owner}/{repo}".lower()
+
+
+def read_repository_urls(input_csv, source=None):
+    """
+    Reads the repository URLs of a repository CSV (the second column if there are several, as in
+    the 'Name,Source URL' files, otherwise the first one).
+    With a source (e.g. puppet_urls.csv), only the rows of an index written by write_index that
+    list it in their 'Sources' column are read.
+    """
+    urls = []
+    with open(input_csv, mode='r') as infile:
+        reader = csv.reader(infile)
+        next(reader, None)  # Skip header
+        for row in reader:
+            if not row:
+                continue
+            if source and (len(row) < 3 or source not in row[2].split(';')):
+                continue
+            urls.append(row[1] if len(row) >= 2 else row[0])
+    return urls
+
+
+def build_index(input_csvs):
+    """
+    Builds the canonical index of the repositories listed in several repository CSVs.
+
+    Parameters:
+    - input_csvs (list): Paths of the repository CSVs.
+    Returns:
+    - tuple: The index, mapping each canonical name to a dict with the 'owner', 'repo' and the
+      'sources' (input CSVs) it was found in, in order of first appearance; and a dict of statistics.
+    """
+    index = {}
+    stats = {'rows': 0, 'unique_urls': 0, 'not_github': 0}
+    raw_urls = set()
+    for input_csv in input_csvs:
+        for url in read_repository_urls(input_csv):
+            stats['rows'] += 1
+            owner, repo = parse_github_url(url)
+            if owner is None:
+                stats['not_github'] += 1
+                continue
+            raw_urls.add(url)
+            entry = index.setdefault(canonical_name(owner, repo), {'owner': owner, 'repo': repo, 'sources': []})
+            if input_csv not in entry['sources']:
+                entry['sources'].append(input_csv)
+    stats['unique_urls'] = len(raw_urls)
+    # fetch_issues.py harvests every repository once per input CSV it is listed in
+    stats['per_source'] = sum(len(entry['sources']) for entry in index.values())
+    return index, stats
+
+
+def resolve_renames(index, client, batch_size=100):
+    """
+    Resolves renamed and transferred repositories through GitHub (which redirects old names to the
+    current `nameWithOwner`), with batch_size repositories per aliased GraphQL query. Entries that
+    resolve to the same repository are merged and missing repositories are dropped.
+
+    Returns:
+    - tuple: The resolved index and the number of missing repositories.
+    """
+    names = list(index)
+    resolved = {}
+    missing = 0
+    metrics = metrics_of(client.session)
+    metrics.expect(len(names))
+    for start in range(0, len(names), batch_size):
+        batch = names[start:start + batch_size]
+        aliases = "".join("""
+          r{position}: repository(owner: {owner}, name: {repo}) {{
+            nameWithOwner
+          }}""".format(position=position, owner=json.dumps(index[name]['owner']), repo=json.dumps(index[name]['repo']))
+            for position, name in enumerate(batch))
+        try:
+            result = client.graphql("{" + aliases + "\n        }")
+        except requests.HTTPError as e:
+            print(f"Error resolving repositories: {e}")
+            result = {}
+        metrics.done(len(batch))
+        if not result.get('data'):
+            # The whole query failed; keep the entries unresolved
+            for name in batch:
+                resolved.setdefault(name, index[name])
+            continue
+        for position, name in enumerate(batch):
+            repository = result['data'].get(f"r{position}")
+            if repository is None:
+                missing += 1
+                continue
+            owner, repo = repository['nameWithOwner'].split('/')
+            entry = resolved.setdefault(canonical_name(owner, repo), {'owner': owner, 'repo': repo, 'sources': []})
+            entry['sources'] += [source for source in index[name]['sources'] if source not in entry['sources']]
+    return resolved, missing
+
+
+def write_index(index, output_csv):
+    # Same format as the repository CSVs, so the output can be fed to fetch_issues.py directly,
+    # plus the input CSVs each repository was found in, so that the harvest can be split by ecosystem
+    with open(output_csv, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Name', 'Source URL', 'Sources'])
+        for entry in index.values():
+            writer.writerow([f"{entry['owner']}/{entry['repo']}", f"https://github.com/{entry['owner']}/{entry['repo']}",
+                             ';'.join(os.path.basename(source) for source in entry['sources'])])
+
+
+def main(input_csvs, output_csv, tokens=None, session=None):
+    index, stats = build_index(input_csvs)
+    unique = len(index)
+    missing = 0
+    if tokens:
+        client = GitHubClient(tokens, session=session)
+        index, missing = resolve_renames(index, client)
+    write_index(index, output_csv)
+
+    print(f"Repository URLs read: {stats['rows']} ({stats['not_github']} not on GitHub, {stats['unique_urls']} distinct GitHub URLs)")
+    print(f"Unique repositories after URL normalization: {unique} ({stats['per_source']} when each input CSV is harvested on its own)")
+    if tokens:
+        print(f"Unique repositories after resolving renames: {len(index)} ({missing} no longer exist)")
+    # Compared to harvesting every input CSV separately; the issues of the single harvest are
+    # split by ecosystem through the Sources column
+    print(f"Harvest queries saved by harvesting the index once: at least {stats['per_source'] - len(index)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build a canonical index of unique GitHub repositories from repository CSVs.')
+    parser.add_argument('input_csvs', type=str, nargs='+', help='Repository CSV files (e.g. the four files of data/collection/repositories/).')
+    parser.add_argument('--output', type=str, required=True, help='Output CSV file path to save the unique repositories.')
+    parser.add_argument('--resolve', action='store_true', help='Resolve renamed and deleted repositories through the GitHub API (needs a token).')
+    parser.add_argument('--gh-token', type=str, default=None, help='Your GitHub access token (or several comma-separated tokens).')
+    parser.add_argument('--tokens-file', type=str, default=None, help='File with additional GitHub access tokens, one per line.')
+    add_session_arguments(parser)
+    args = parser.parse_args()
+
+    tokens = load_tokens(args.gh_token, args.tokens_file) if args.resolve else None
+    main(args.input_csvs, args.output, tokens, session_from_args(args))
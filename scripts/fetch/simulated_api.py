@@ -0,0 +1,422 @@
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import parse_qs, urlsplit
+
+from requests.adapters import BaseAdapter
+
+from replay import build_response
+
+GALAXY_INDEX = '/api/v3/plugin/ansible/content/published/collections/index/'
+
+
+class SimulatedAPI(BaseAdapter):
+    """
+    A transport adapter that simulates the APIs used by the data collection scripts (GitHub GraphQL
+    and REST, Puppet Forge, Chef Supermarket, Ansible Galaxy and the Puppet Jira) on synthetic data,
+    so that the scripts can be benchmarked without spending real API budget.
+
+    Parameters:
+    - repositories (int): Number of synthetic GitHub repositories (named sim/repo<i>).
+    - mean_issues (int): Mean number of closed issues per repository; sizes follow an exponential
+      distribution, so most repositories are small and a few are large. One in ten repositories is
+      a fork without issues, and one in ten is archived.
+    - registry_size (int): Number of modules / cookbooks / collections / roles / Jira issues.
+    - latency (float): Seconds to wait before every response.
+    - error_rate (float): Probability of answering a request with a 502.
+    - rate_limit (int): GitHub rate limit points per window of window seconds.
+    - max_page_size (int): If given, GraphQL queries requesting more issues in total time out
+      (with GitHub's 502), like the queries of heavy repositories do.
+    - seed (int): Seed of the synthetic data and of the injected errors.
+    """
+
+    def __init__(self, repositories=100, mean_issues=30, registry_size=300, latency=0.0,
+                 error_rate=0.0, rate_limit=5000, window=3600, max_page_size=None, seed=0):
+        super().__init__()
+        self.max_page_size = max_page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.window = window
+        rng = random.Random(seed)
+        self._rng = random.Random(seed + 1)
+        self.repositories = {f"repo{index}": int(rng.expovariate(1 / mean_issues)) if mean_issues else 0
+                             for index in range(repositories)}
+        flags = random.Random(seed + 2)
+        self.forks = {repo for repo in self.repositories if flags.random() < 0.1}
+        self.archived = {repo for repo in self.repositories if flags.random() < 0.1}
+        for repo in self.forks:
+            self.repositories[repo] = 0
+        # The closer of every issue: a fix (PullRequest or Commit) or None for a plain close
+        self.closers = [rng.choice(['PullRequest', 'Commit', None, None]) for _ in range(max(self.repositories.values(), default=0) + 1)]
+        self.registry_size = registry_size
+        # Jira issues reopened, and updated since the last sync (by default the ten most recent)
+        self.jira_reopened = set()
+        self.jira_updated = set(range(max(registry_size - 10, 0), registry_size))
+        self.requests = 0
+        self.points = 0
+        self.errors = 0
+        self._window_start = time.time()
+        self._window_points = 0
+        self._lock = threading.Lock()
+
+    def expected_issues(self, closers=('PullRequest', 'Commit'), skip_archived=False):
+        # Number of fix-closed issues a complete harvest finds
+        return sum(1 for repo, size in self.repositories.items() for number in range(size)
+                   if self.closers[number] in closers and not (skip_archived and repo in self.archived))
+
+    def _consume(self, points):
+        # Returns the rate limit figures after consuming the points, or None when over the limit
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.window:
+                self._window_start = now
+                self._window_points = 0
+            if self._window_points + points > self.rate_limit:
+                return None, self._window_start + self.window
+            self._window_points += points
+            self.points += points
+            return self.rate_limit - self._window_points, self._window_start + self.window
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests += 1
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return build_response(request, 502, {'Content-Type': 'text/html'}, b'<html>502 Bad Gateway</html>', self)
+        url = urlsplit(request.url)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.netloc == 'api.github.com':
+            status, body, headers = self._github(request, url.path, params)
+        elif url.netloc == 'forgeapi.puppet.com':
+            status, body, headers = self._forge(params)
+        elif url.netloc == 'supermarket.chef.io':
+            status, body, headers = self._supermarket(url.path, params)
+        elif url.netloc == 'galaxy.ansible.com':
+            status, body, headers = self._galaxy(url.path, params)
+        elif url.netloc == 'puppet.atlassian.net':
+            status, body, headers = self._jira(url.path, params)
+        else:
+            status, body, headers = 404, {'message': 'Not Found'}, {}
+        headers['Content-Type'] = 'application/json'
+        return build_response(request, status, headers, json.dumps(body).encode(), self)
+
+    def close(self):
+        pass
+
+    # GitHub
+
+    def _closer(self, repo, number):
+        closer = self.closers[number]
+        if closer == 'PullRequest':
+            return {'__typename': closer, 'url': f"https://github.com/sim/{repo}/pull/{number + 1}"}
+        if closer == 'Commit':
+            oid = f"{number + 1:040x}"
+            return {'__typename': closer, 'oid': oid, 'url': f"https://github.com/sim/{repo}/commit/{oid}"}
+        return None
+
+    def _issue_node(self, repo, number):
+        return {
+            'url': f"https://github.com/sim/{repo}/issues/{number + 1}",
+            'title': f"Issue {number + 1}",
+            'body': "Synthetic issue body\n```\ncode\n```",
+            'createdAt': '2010-01-01T00:00:00Z',
+            'closedAt': self._closed_on(number).isoformat() + 'T00:00:00Z',
+        }
+
+    def _closed_on(self, number):
+        # Eight issues are closed per day from 2010-01-01, so that search date windows split them
+        return date(2010, 1, 1) + timedelta(days=number // 8)
+
+    def _timeline(self, repo, number):
+        return {'edges': [{'node': {'__typename': 'ClosedEvent', 'closer': self._closer(repo, number)}}]}
+
+    def _issues_page(self, repo, first, after, since=None):
+        # Issues are last updated when they are closed, so `since` filters on the closing date
+        numbers = [number for number in range(self.repositories[repo])
+                   if since is None or self._closed_on(number).isoformat() >= since[:10]]
+        start = int(after.split(':')[1]) if after else 0
+        end = min(start + first, len(numbers))
+        edges = []
+        for number in numbers[start:end]:
+            node = self._issue_node(repo, number)
+            node['timelineItems'] = self._timeline(repo, number)
+            edges.append({'node': node})
+        return {
+            'edges': edges,
+            'pageInfo': {'endCursor': f"cursor:{end}", 'hasNextPage': end < len(numbers)},
+        }
+
+    def _search(self, search, first, after):
+        # Supports the repo:, closed: and linked:pr / reason:completed qualifiers, and the cap of 1000 results
+        repo = re.search(r"repo:sim/(\S+)", search)
+        numbers = range(self.repositories.get(repo.group(1), 0)) if repo else []
+        repo = repo.group(1) if repo else None
+        if 'linked:pr' in search:
+            numbers = [number for number in numbers if self.closers[number] == 'PullRequest']
+        elif 'reason:completed' in search:
+            numbers = [number for number in numbers if self.closers[number]]
+        closed = re.search(r"closed:(\d{4}-\d\d-\d\d)\.\.(\d{4}-\d\d-\d\d)", search)
+        if closed:
+            start, end = date.fromisoformat(closed.group(1)), date.fromisoformat(closed.group(2))
+            numbers = [number for number in numbers if start <= self._closed_on(number) <= end]
+        numbers = list(numbers)
+        served = min(len(numbers), 1000)
+        start = int(after.split(':')[1]) if after else 0
+        end = min(start + first, served)
+        edges = []
+        for number in numbers[start:end]:
+            node = self._issue_node(repo, number)
+            node['timelineItems'] = self._timeline(repo, number)
+            edges.append({'node': node})
+        return {
+            'issueCount': len(numbers),
+            'edges': edges,
+            'pageInfo': {'endCursor': f"cursor:{end}", 'hasNextPage': end < served},
+        }
+
+    def _fix_files(self, repo, number):
+        # The files changed by the fix of an issue; about every tenth fix is a large one
+        files = [
+            {'filename': 'manifests/init.pp', 'additions': 10, 'deletions': 2},
+            {'filename': 'spec/classes/init_spec.rb', 'additions': 20, 'deletions': 0},
+            {'filename': 'templates/config.erb', 'additions': 1, 'deletions': 1},
+        ]
+        if (number + int(repo[len('repo'):])) % 10 == 0:
+            files += [{'filename': f'manifests/part{index}.pp', 'additions': 1, 'deletions': 1} for index in range(250)]
+        return files
+
+    def expected_fix_lines(self, repo, number):
+        # Lines added by the fix of an issue, once all its files are counted
+        return sum(file['additions'] for file in self._fix_files(repo, number))
+
+    def _github(self, request, path, params):
+        if path == '/graphql':
+            payload = json.loads(request.body)
+            return self._graphql(payload['query'], payload.get('variables') or {})
+        remaining, reset = self._consume(1)
+        if remaining is None:
+            return 403, {'message': 'API rate limit exceeded'}, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(reset))}
+        headers = {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(remaining),
+                   'X-RateLimit-Reset': str(int(reset)), 'X-RateLimit-Resource': 'core'}
+        match = re.match(r"/repos/sim/([^/]+)/(pulls/(\d+)/files|commits/([0-9a-f]{40}))$", path)
+        if not match:
+            return 404, {'message': 'Not Found'}, headers
+        number = int(match.group(3) or match.group(4), 10 if match.group(3) else 16) - 1
+        files = self._fix_files(match.group(1), number)
+        # Files are paginated like on GitHub: 30 per page for pull requests, 300 for commits by default
+        page = int(params.get('page', 1))
+        per_page = int(params.get('per_page', 30 if match.group(3) else 300))
+        if page * per_page < len(files):
+            headers['Link'] = f'<https://api.github.com{path}?page={page + 1}&per_page={per_page}>; rel="next"'
+        files = files[(page - 1) * per_page:page * per_page]
+        if match.group(3):
+            return 200, files, headers
+        return 200, {'files': files}, headers
+
+    def _graphql(self, query, variables):
+        issue_connections = re.findall(r"issues\(first: (\d+)", query)
+        if self.max_page_size and sum(int(first) for first in issue_connections) > self.max_page_size:
+            return 502, {'message': 'Server Error'}, {}
+        connections = issue_connections + re.findall(r"files\(first: (\d+)", query)
+        points = max(1, round(sum(1 + int(first) for first in connections) / 100))
+        remaining, reset = self._consume(points)
+        reset_at = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(reset))
+        if remaining is None:
+            return 200, {'errors': [{'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'}]}, \
+                {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(reset))}
+        headers = {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(remaining),
+                   'X-RateLimit-Reset': str(int(reset)), 'X-RateLimit-Resource': 'graphql'}
+        data = {'rateLimit': {'cost': points, 'limit': self.rate_limit, 'remaining': remaining, 'resetAt': reset_at}}
+        errors = []
+
+        closure_pattern = r"(\w+): repository\(owner: \"([^\"]+)\", name: \"([^\"]+)\"\) \{\s*issue\(number: (\d+)\)"
+        if re.search(closure_pattern, query):
+            # Closure information of aliased issues (see quantitative_analysis.get_closure_infos)
+            for alias, owner, repo, number in re.findall(closure_pattern, query):
+                number = int(number) - 1
+                if owner != 'sim' or repo not in self.repositories:
+                    data[alias] = None
+                    errors.append({'type': 'NOT_FOUND', 'path': [alias]})
+                    continue
+                if number >= self.repositories[repo]:
+                    data[alias] = {'issue': None}
+                    errors.append({'type': 'NOT_FOUND', 'path': [alias, 'issue']})
+                    continue
+                node = self._issue_node(repo, number)
+                data[alias] = {'issue': {
+                    'createdAt': node['createdAt'],
+                    'closedAt': node['closedAt'],
+                    'timelineItems': {'nodes': [{'__typename': 'ClosedEvent', 'closer': self._closer(repo, number)}]},
+                }}
+            result = {'data': data}
+            if errors:
+                result['errors'] = errors
+            return 200, result, headers
+
+        files_pattern = (r"(\w+): repository\(owner: \"([^\"]+)\", name: \"([^\"]+)\"\) \{\s*"
+                         r"pullRequest\(number: (\d+)\) \{\s*files\(first: (\d+), after: (null|\"[^\"]*\")\)")
+        if re.search(files_pattern, query):
+            # Changed files of aliased pull requests (see quantitative_analysis.get_pr_files)
+            for alias, owner, repo, number, first, after in re.findall(files_pattern, query):
+                number = int(number) - 1
+                if owner != 'sim' or repo not in self.repositories:
+                    data[alias] = None
+                    errors.append({'type': 'NOT_FOUND', 'path': [alias]})
+                    continue
+                if number >= self.repositories[repo] or self.closers[number] != 'PullRequest':
+                    data[alias] = {'pullRequest': None}
+                    errors.append({'type': 'NOT_FOUND', 'path': [alias, 'pullRequest']})
+                    continue
+                files = self._fix_files(repo, number)
+                start = int(json.loads(after).split(':')[1]) if json.loads(after) else 0
+                end = min(start + int(first), len(files))
+                data[alias] = {'pullRequest': {'files': {
+                    'nodes': [{'path': file['filename'], 'additions': file['additions'], 'deletions': file['deletions']}
+                              for file in files[start:end]],
+                    'pageInfo': {'endCursor': f"cursor:{end}", 'hasNextPage': end < len(files)},
+                }}}
+            result = {'data': data}
+            if errors:
+                result['errors'] = errors
+            return 200, result, headers
+
+        if 'hasIssuesEnabled' in query:
+            for alias, owner, repo in re.findall(r"(\w+): repository\(owner: \"([^\"]+)\", name: \"([^\"]+)\"\)", query):
+                if owner != 'sim' or repo not in self.repositories:
+                    data[alias] = None
+                    errors.append({'type': 'NOT_FOUND', 'path': [alias]})
+                    continue
+                data[alias] = {
+                    'isFork': repo in self.forks,
+                    'isArchived': repo in self.archived,
+                    'hasIssuesEnabled': repo not in self.forks,
+                    'issues': {'totalCount': self.repositories[repo]},
+                }
+            result = {'data': data}
+            if errors:
+                result['errors'] = errors
+            return 200, result, headers
+
+        search = re.search(r'search\(query: ("(?:[^"\\]|\\.)*"), type: ISSUE, first: (\d+), after: (null|"[^"]*")\)', query)
+        if search:
+            data['search'] = self._search(json.loads(search.group(1)), int(search.group(2)), json.loads(search.group(3)))
+            return 200, {'data': data}, headers
+
+        pattern = (r"(?:(\w+): )?repository\(owner: \"([^\"]+)\", name: \"([^\"]+)\"\) \{\s*"
+                   r"issues\(first: (\d+), after: (null|\"[^\"]*\"), states: CLOSED(?:, filterBy: \{since: (\"[^\"]*\")\})?")
+        for alias, owner, repo, first, after, since in re.findall(pattern, query):
+            alias = alias or 'repository'
+            if owner != 'sim' or repo not in self.repositories:
+                data[alias] = None
+                errors.append({'type': 'NOT_FOUND', 'path': [alias]})
+                continue
+            data[alias] = {'issues': self._issues_page(repo, int(first), json.loads(after),
+                                                       json.loads(since) if since else None)}
+        result = {'data': data}
+        if errors:
+            result['errors'] = errors
+        return 200, result, headers
+
+    # Registries
+
+    def _forge(self, params):
+        limit, offset = int(params.get('limit', 20)), int(params.get('offset', 0))
+        results = [{
+            'current_release': {'metadata': {'name': f"sim-module{index}", 'source': f"https://github.com/sim/module{index}"}},
+            'issues_url': f"https://github.com/sim/module{index}/issues",
+            'homepage_url': None,
+        } for index in range(offset, min(offset + limit, self.registry_size))]
+        has_next = offset + limit < self.registry_size
+        next_url = f"/v3/modules?limit={limit}&offset={offset + limit}" if has_next else None
+        return 200, {'pagination': {'limit': limit, 'offset': offset, 'total': self.registry_size, 'next': next_url},
+                     'results': results}, {}
+
+    def _supermarket(self, path, params):
+        if path == '/api/v1/cookbooks':
+            start, items = int(params.get('start', 0)), int(params.get('items', 10))
+            return 200, {'start': start, 'total': self.registry_size, 'items': [{
+                'cookbook_name': f"cookbook{index}",
+                'cookbook': f"https://supermarket.chef.io/api/v1/cookbooks/cookbook{index}",
+            } for index in range(start, min(start + items, self.registry_size))]}, {}
+        if path == '/universe':
+            return 200, {f"cookbook{index}": {'1.0.0': {'location_type': 'opscode'}}
+                         for index in range(self.registry_size)}, {}
+        name = path.rsplit('/', 1)[-1]
+        return 200, {
+            'name': name,
+            'source_url': f"https://github.com/sim/{name}",
+            'latest_version': f"https://supermarket.chef.io/api/v1/cookbooks/{name}/versions/1.0.0",
+        }, {}
+
+    def _galaxy(self, path, params):
+        if path == GALAXY_INDEX:
+            limit, offset = int(params.get('limit', 10)), int(params.get('offset', 0))
+            has_next = offset + limit < self.registry_size
+            return 200, {
+                'meta': {'count': self.registry_size},
+                'links': {'next': f"{GALAXY_INDEX}?limit={limit}&offset={offset + limit}" if has_next else None},
+                'data': [{
+                    'namespace': 'sim',
+                    'name': f"collection{index}",
+                    'highest_version': {'href': f"{GALAXY_INDEX}sim/collection{index}/versions/1.0.0/", 'version': '1.0.0'},
+                } for index in range(offset, min(offset + limit, self.registry_size))],
+            }, {}
+        match = re.match(re.escape(GALAXY_INDEX) + r"sim/(collection\d+)/versions/", path)
+        if match:
+            return 200, {'metadata': {'repository': f"https://github.com/sim/{match.group(1)}"}}, {}
+        if path == '/api/v1/roles/':
+            # Like the real API, larger page sizes are capped
+            page, page_size = int(params.get('page', 1)), min(int(params.get('page_size', 10)), 250)
+            start = (page - 1) * page_size
+            has_next = start + page_size < self.registry_size
+            return 200, {
+                'count': self.registry_size,
+                'next': f"https://galaxy.ansible.com/api/v1/roles/?page={page + 1}&page_size={page_size}" if has_next else None,
+                'results': [{'github_user': 'sim', 'github_repo': f"role{index}"}
+                            for index in range(start, min(start + page_size, self.registry_size))],
+            }, {}
+        return 404, {'detail': 'Not found.'}, {}
+
+    def _jira_comments(self, index):
+        # Every third issue links its fix in its last comment, and every fifth issue has 30 comments
+        text = f"Fixed in https://github.com/sim/module{index}/pull/1" if index % 3 == 0 else "Thanks"
+        comments = [{'body': {'type': 'doc', 'content': [{'type': 'paragraph', 'content': [{'type': 'text', 'text': "Thanks"}]}]}}
+                    for _ in range(29 if index % 5 == 0 else 0)]
+        return comments + [{'body': {'type': 'doc', 'content': [{'type': 'paragraph', 'content': [{'type': 'text', 'text': text}]}]}}]
+
+    def _jira(self, path, params):
+        if path == '/rest/api/3/search':
+            start, max_results = int(params.get('startAt', 0)), min(int(params.get('maxResults', 50)), 100)
+            jql = params.get('jql', '')
+            indices = [index for index in range(self.registry_size)
+                       if ('status in' not in jql or index not in self.jira_reopened)
+                       and ('updated >=' not in jql or index in self.jira_updated | self.jira_reopened)]
+            issues = []
+            for index in indices[start:start + max_results]:
+                fields = {'status': {'name': 'Reopened' if index in self.jira_reopened else 'Closed'}}
+                if 'comment' in params.get('fields', '').split(','):
+                    # Like Jira, the search response only embeds the first comments
+                    comments = self._jira_comments(index)
+                    fields['comment'] = {'startAt': 0, 'maxResults': 20, 'total': len(comments), 'comments': comments[:20]}
+                issues.append({'key': f"PUP-{index}", 'fields': fields})
+            return 200, {
+                'startAt': start,
+                'maxResults': max_results,
+                'total': len(indices),
+                'issues': issues,
+            }, {}
+        match = re.match(r"/rest/api/3/issue/PUP-(\d+)/comment$", path)
+        if match:
+            comments = self._jira_comments(int(match.group(1)))
+            start, max_results = int(params.get('startAt', 0)), int(params.get('maxResults', 50))
+            return 200, {'startAt': start, 'maxResults': max_results, 'total': len(comments),
+                         'comments': comments[start:start + max_results]}, {}
+        return 404, {'errorMessages': ['Issue does not exist']}, {}
@@ -1,29 +1,53 @@
-import requests
 import re
 import csv
 import argparse
+import os
+import sys
+import json
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# The GitHub client is shared with the data collection scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fetch'))
+from github_client import GitHubClient, load_tokens
+from http_session import add_session_arguments, session_from_args
+from metrics import metrics_of
+from ratelimit import backoff_delay
 
 
 def get_args():
     parser = argparse.ArgumentParser(
         description='Generate rq3 figures')
     parser.add_argument("data", help="CSV with bugs.")
-    parser.add_argument("gh_token", help="Github Access Token")
+    parser.add_argument("gh_token", help="Github Access Token (or several comma-separated tokens)")
+    parser.add_argument(
+            "--tokens-file",
+            default=None,
+            help="File with additional Github Access Tokens, one per line.")
     parser.add_argument(
             "--output",
             default="quantitative_metrics.csv",
             help="Filename to save the qualitative metrics.")
+    parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of fixes fetched concurrently.")
+    add_session_arguments(parser)
     return parser.parse_args()
 
 
 
-def get_jira_date(url):
+def get_jira_date(url, session):
     """
     Fetches the creation and resolution dates for a JIRA issue given its URL.
 
     Parameters:
     - url: The URL of the JIRA issue.
+    - session: The requests session used to send the request.
 
     Returns:
     A tuple containing the creation date and resolution date (or 'Not Resolved' if not applicable).
@@ -43,7 +67,7 @@ def get_jira_date(url):
        "Accept": "application/json"
     }
 
-    response = requests.get(api_url, headers=headers)
+    response = session.get(api_url, headers=headers)
 
     if response.status_code == 200:
         issue_data = response.json()
@@ -60,6 +84,11 @@ def get_jira_date(url):
         return None, None
 
 
+# Stands in for the unit counts of a fix whose files could not be fetched
+MISSING_UNITS = {unit: {'files': '', 'lines_added': '', 'lines_removed': ''}
+                 for unit in ('config_units', 'iac_program_units', 'test_units', 'template_units')}
+
+
 def save_to_csv(issue_details, output):
     """
     Saves the collected issue details to a CSV file.
@@ -78,24 +107,26 @@ def save_to_csv(issue_details, output):
         writer.writeheader()
 
         for issue, details in issue_details.items():
+            # The metrics of a fix that could not be fetched are left empty
+            units = details if 'config_units' in details else MISSING_UNITS
             row = {
                 'Issue URL': issue,
                 'Fix URL': details['fix_url'],
                 'Ecosystem': details['ecosystem'],
                 'Created At': details['created_at'].split('T')[0],
                 'Closed At': details['closed_at'].split('T')[0],
-                'Config Unit Files Count': details['config_units']['files'],
-                'Config Unit Lines Added': details['config_units']['lines_added'],
-                'Config Unit Lines Removed': details['config_units']['lines_removed'],
-                'IAC Program Unit Files Count': details['iac_program_units']['files'],
-                'IAC Program Unit Lines Added': details['iac_program_units']['lines_added'],
-                'IAC Program Unit Lines Removed': details['iac_program_units']['lines_removed'],
-                'Test Unit Files Count': details['test_units']['files'],
-                'Test Unit Lines Added': details['test_units']['lines_added'],
-                'Test Unit Lines Removed': details['test_units']['lines_removed'],
-                'Template Unit Files Count': details['template_units']['files'],
-                'Template Unit Lines Added': details['template_units']['lines_added'],
-                'Template Unit Lines Removed': details['template_units']['lines_removed'],
+                'Config Unit Files Count': units['config_units']['files'],
+                'Config Unit Lines Added': units['config_units']['lines_added'],
+                'Config Unit Lines Removed': units['config_units']['lines_removed'],
+                'IAC Program Unit Files Count': units['iac_program_units']['files'],
+                'IAC Program Unit Lines Added': units['iac_program_units']['lines_added'],
+                'IAC Program Unit Lines Removed': units['iac_program_units']['lines_removed'],
+                'Test Unit Files Count': units['test_units']['files'],
+                'Test Unit Lines Added': units['test_units']['lines_added'],
+                'Test Unit Lines Removed': units['test_units']['lines_removed'],
+                'Template Unit Files Count': units['template_units']['files'],
+                'Template Unit Lines Added': units['template_units']['lines_added'],
+                'Template Unit Lines Removed': units['template_units']['lines_removed'],
             }
             writer.writerow(row)
 
@@ -189,31 +220,15 @@ def get_chef_category(file_path):
         category = None
     return category
 
-def get_commit_details(commit_url, ecosystem, headers):
+def count_files(files_data, ecosystem):
     """
-    Fetches details for a given commit URL within a specific ecosystem.
+    Counts the files of a fix and their changed lines per unit type.
     Parameters:
-    - commit_url (str): The URL of the commit.
-    - ecosystem (str): The ecosystem to which the commit belongs.
+    - files_data (list): The changed files, as dicts with the filename, additions, and deletions.
+    - ecosystem (str): The ecosystem to which the fix belongs.
     Returns:
-    - dict: A dictionary containing details of the commit categorized by unit type.
+    - dict: A dictionary containing details of the fix categorized by unit type.
     """
-    match = re.search(r"github\.com/(.+)/(.+)/commit/([0-9a-f]{40})", commit_url)
-    if not match:
-        return "Invalid commit URL", commit_url
-
-    owner, repo, commit_sha = match.groups()
-
-    # Fetch commit details
-    commit_details_url = f"https://api.github.com/repos/{owner}/{repo}/commits/{commit_sha}"
-    commit_response = requests.get(commit_details_url, headers=headers)
-    commit_data = commit_response.json()
-
-    # Check if the commit data has the 'files' key
-    if 'files' not in commit_data:
-        return None, None, None  # Or handle error as needed
-
-    files_data = commit_data['files']
     details = {
         'config_units': {'files': 0, 'lines_added': 0, 'lines_removed': 0},
         'iac_program_units': {'files': 0, 'lines_added': 0, 'lines_removed': 0},
@@ -235,44 +250,164 @@ def get_commit_details(commit_url, ecosystem, headers):
 
     return details
 
-def get_pr_details(pr_url, ecosystem, headers):
+def get_commit_details(commit_url, ecosystem, client):
+    """
+    Fetches details for a given commit URL within a specific ecosystem.
+    GraphQL has no list of the files of a commit, so they are fetched from the REST API,
+    following the pagination of commits with more than 300 files.
+    Parameters:
+    - commit_url (str): The URL of the commit.
+    - ecosystem (str): The ecosystem to which the commit belongs.
+    - client (GitHubClient): The client used to send the GitHub API requests.
+    Returns:
+    - dict: A dictionary containing details of the commit categorized by unit type.
+    """
+    match = re.search(r"github\.com/(.+)/(.+)/commit/([0-9a-f]{40})", commit_url)
+    if not match:
+        return "Invalid commit URL", commit_url
+
+    owner, repo, commit_sha = match.groups()
+
+    # Fetch commit details, page by page
+    commit_details_url = f"https://api.github.com/repos/{owner}/{repo}/commits/{commit_sha}"
+    files_data = []
+    while commit_details_url:
+        commit_response = client.get(commit_details_url)
+        commit_data = commit_response.json()
+
+        # Check if the commit data has the 'files' key
+        if 'files' not in commit_data:
+            return None, None, None  # Or handle error as needed
+
+        files_data += commit_data['files']
+        commit_details_url = commit_response.links.get('next', {}).get('url')
+
+    return count_files(files_data, ecosystem)
+
+def parse_pr_url(pr_url):
+    """
+    Parses a GitHub pull request URL.
+    Returns:
+    - tuple: The owner, repository, and pull request number (as integer), or None if parsing fails.
+    """
+    match = re.search(r"github\.com/(.+)/(.+)/pull/(\d+)", pr_url)
+    if match:
+        return match.group(1), match.group(2), int(match.group(3))
+    return None
+
+def pr_files_query(page):
+    owner, repo, number, cursor = page
+    return """repository(owner: {owner}, name: {repo}) {{
+        pullRequest(number: {number}) {{
+          files(first: 100, after: {cursor}) {{
+            nodes {{
+              path
+              additions
+              deletions
+            }}
+            pageInfo {{
+              hasNextPage
+              endCursor
+            }}
+          }}
+        }}
+      }}""".format(owner=json.dumps(owner), repo=json.dumps(repo), number=number, cursor=json.dumps(cursor))
+
+def get_pr_files(pulls, client, batch_size=50):
+    """
+    Fetches the files changed by many pull requests, with their first 100 files for batch_size
+    pull requests per aliased GraphQL query (see batched_graphql). The next pages of the files of
+    larger pull requests are fetched in the same way until all the files are fetched.
+    Parameters:
+    - pulls (list): (owner, repository, pull request number) tuples.
+    - client (GitHubClient): The client used to send the GitHub API requests.
+    Returns:
+    - dict: The changed files of every pull request (as dicts with the filename, additions, and
+      deletions, like the REST API returns them), or None for a pull request whose files could
+      not all be fetched.
+    """
+    files = {pull: [] for pull in pulls}
+    pages = [pull + (None,) for pull in files]
+    while pages:
+        next_pages = []
+        for page, repository in batched_graphql(pages, client, pr_files_query, batch_size):
+            pull = page[:3]
+            pull_request = repository and repository.get('pullRequest')
+            if pull_request is None:
+                files[pull] = None
+                continue
+            files[pull] += [{'filename': node['path'], 'additions': node['additions'], 'deletions': node['deletions']}
+                            for node in pull_request['files']['nodes']]
+            page_info = pull_request['files']['pageInfo']
+            if page_info['hasNextPage']:
+                next_pages.append(pull + (page_info['endCursor'],))
+        pages = next_pages
+    return files
+
+def get_pr_details(pr_url, ecosystem, client):
     """
     Fetches details for a given pull request URL within a specific ecosystem.
     Parameters:
     - pr_url (str): The URL of the pull request.
     - ecosystem (str): The ecosystem to which the pull request belongs.
+    - client (GitHubClient): The client used to send the GitHub API requests.
     Returns:
     - dict: A dictionary containing details of the pull request categorized by unit type.
     """
-    match = re.search(r"github\.com/(.+)/(.+)/pull/(\d+)", pr_url)
-    if not match:
+    pull = parse_pr_url(pr_url)
+    if not pull:
         return "Invalid PR URL", pr_url
 
-    owner, repo, pull_number = match.groups()
-
     # Fetch files touched by the PR
-    files_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}/files"
-    files_response = requests.get(files_url, headers=headers)
-    files_data = files_response.json()
-    details = {
-        'config_units': {'files': 0, 'lines_added': 0, 'lines_removed': 0},
-        'iac_program_units': {'files': 0, 'lines_added': 0, 'lines_removed': 0},
-        'test_units': {'files': 0, 'lines_added': 0, 'lines_removed': 0},
-        'template_units': {'files': 0, 'lines_added': 0, 'lines_removed': 0},
+    files_data = get_pr_files([pull], client)[pull]
+    if files_data is None:
+        return None, None, None  # The PR could not be fetched
+    return count_files(files_data, ecosystem)
 
-    }
-    for file in files_data:
-        file_path = file['filename']
-        additions = file['additions']
-        deletions = file['deletions']
-        category = get_category(ecosystem, file_path)
-        if category:
-            # Update counters
-            details[category]['files'] += 1
-            details[category]['lines_added'] += additions
-            details[category]['lines_removed'] += deletions
 
-    return details
+def get_fix_details(fix_url, ecosystem, client):
+    """
+    Fetches the details of a fix, from its pull request or its commit.
+    Returns:
+    - dict: A dictionary containing details of the fix categorized by unit type.
+    """
+    if "/pull/" in fix_url:
+        return get_pr_details(fix_url, ecosystem, client)
+    return get_commit_details(fix_url, ecosystem, client)
+
+
+def get_all_fix_details(fixes, client, workers=8, batch_size=50):
+    """
+    Fetches the details of many fixes: the files of the pull requests in batches of batch_size
+    pull requests per GraphQL query, while the commits are fetched concurrently from the REST
+    API by workers threads, all sharing the connection pool and the rate limit budget of the client.
+    Parameters:
+    - fixes (list): (fix URL, ecosystem) tuples.
+    - client (GitHubClient): The client used to send the GitHub API requests.
+    - workers (int): The number of commits fetched concurrently.
+    - batch_size (int): The number of pull requests per GraphQL query.
+    Returns:
+    - list: The details of every fix (see get_fix_details), in the order of fixes. A fix that
+      could not be fetched has a tuple instead of the dict.
+    """
+    metrics = metrics_of(client.session)
+
+    def fetch(fix):
+        details = get_commit_details(fix[0], fix[1], client)
+        metrics.done()
+        return details
+
+    pull_fixes = [(fix_url, ecosystem, parse_pr_url(fix_url)) for fix_url, ecosystem in fixes if "/pull/" in fix_url]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # The commits are fetched in the background while the pull requests are batched
+        commit_details = executor.map(fetch, [fix for fix in fixes if "/pull/" not in fix[0]])
+        pr_files = get_pr_files([pull for _, _, pull in pull_fixes if pull], client, batch_size)
+        metrics.done(len(pull_fixes))
+        # A PR that could not be fetched gets (None, None, None), like a commit without files
+        pull_details = iter([("Invalid PR URL", fix_url) if not pull else
+                             (None, None, None) if pr_files[pull] is None else count_files(pr_files[pull], ecosystem)
+                             for fix_url, ecosystem, pull in pull_fixes])
+        return [next(pull_details) if "/pull/" in fix_url else next(commit_details) for fix_url, _ in fixes]
 
 
 def parse_url(url):
@@ -310,20 +445,8 @@ def get_urls_from_csv(filepath):
     return urls
 
 
-def get_closure_info(owner, repo, issue_number, headers):
-    """
-    Fetches closure information for a GitHub issue given the owner, repository, and issue number.
-    Parameters:
-    - owner (str): The owner of the repository.
-    - repo (str): The name of the repository.
-    - issue_number (int): The number of the issue.
-    Returns:
-    - tuple: A tuple containing the type of closure (PR/Commit), closure URL, creation date, and closure date.
-    """
-    query = """
-    query($owner: String!, $repo: String!, $number: Int!) {
-      repository(owner: $owner, name: $repo) {
-        issue(number: $number) {
+# Fields of an issue that tell when it was created and closed, and by which pull request or commit
+CLOSURE_FIELDS = """
         createdAt
         closedAt
           timelineItems(last: 1, itemTypes: [CLOSED_EVENT]) {
@@ -342,50 +465,133 @@ def get_closure_info(owner, repo, issue_number, headers):
                 }
               }
             }
-          }
-        }
-      }
-    }
-    """
+          }"""
 
-    variables = {
-        'owner': owner,
-        'repo': repo,
-        'number': issue_number,
-    }
 
-    response = requests.post('https://api.github.com/graphql', json={'query': query, 'variables': variables}, headers=headers)
-    data = response.json()
-    if "errors" not in data:
-        closure_info = data['data']['repository']['issue']['timelineItems']['nodes'][0] if data['data']['repository']['issue']['timelineItems']['nodes'] else None
+def closure_tuple(issue):
+    """
+    Returns the closure information of an issue node of a GraphQL response.
+    Parameters:
+    - issue (dict): The issue node (with the CLOSURE_FIELDS), or None if the issue was not found.
+    Returns:
+    - tuple: A tuple containing the type of closure (PR/Commit), closure URL, creation date, and closure date.
+    """
+    if issue:
+        closure_info = issue['timelineItems']['nodes'][0] if issue['timelineItems']['nodes'] else None
 
         if closure_info and closure_info['__typename'] == 'ClosedEvent':
             if closure_info["closer"] and "url" in closure_info["closer"]:
                 closer_type = closure_info['closer']['__typename']
                 closure_url = closure_info['closer']['url']
-                created_at = data['data']['repository']['issue']['createdAt']
-                closed_at = data['data']['repository']['issue']['closedAt']
-                return closer_type, closure_url, created_at, closed_at
-            # else:
-            #     print("Error", closure_info, owner, repo, issue_number)
-    else:
-        rate_limit_reset = int(response.headers.get('X-RateLimit-Reset'))
-        sleep_time = max(rate_limit_reset - int(time.time()), 0) + 10
-        print(f"GitHub API rate limit exceeded. Waiting for {int(sleep_time/60)} minutes...")
-        time.sleep(sleep_time)
-        return get_closure_info(owner, repo, issue_number, headers)
+                return closer_type, closure_url, issue['createdAt'], issue['closedAt']
     return None, None, None, None
 
 
+def batched_graphql(items, client, item_query, batch_size=50, retries=3):
+    """
+    Sends aliased GraphQL queries for many items, with batch_size items per query. A query that
+    fails as a whole is retried (retries times) and then split in halves, so that an item that
+    cannot be resolved only fails on its own.
+    Parameters:
+    - items (list): Tuples starting with the owner, repository, and number of an issue or pull request.
+    - client (GitHubClient): The client used to send the GitHub API requests.
+    - item_query (callable): Returns the query field of an item, e.g. `repository(...) { issue(...) { ... } }`.
+    - batch_size (int): The number of items per query (up to 100).
+    - retries (int): The number of retries of a failed query before it is split.
+    Returns:
+    - generator: An (item, node) tuple for every item, with the node of the item in the response
+      (None if it could not be resolved), as the queries complete.
+    """
+    pending = deque((list(items[i:i + batch_size]), 0) for i in range(0, len(items), batch_size))
+    while pending:
+        batch, attempt = pending.popleft()
+        aliases = "".join(f"""
+      i{position}: {item_query(item)}""" for position, item in enumerate(batch))
+        try:
+            data = client.graphql("query {" + aliases + "\n    }")
+        except requests.RequestException as e:
+            # Transient errors were already retried by the client
+            data = {'errors': [str(e)]}
+        if not data.get('data'):
+            # The query failed as a whole (e.g. it timed out)
+            if attempt < retries:
+                time.sleep(backoff_delay(attempt))
+                pending.append((batch, attempt + 1))
+            elif len(batch) > 1:
+                pending.append((batch[:len(batch) // 2], 0))
+                pending.append((batch[len(batch) // 2:], 0))
+            else:
+                owner, repo, number = batch[0][:3]
+                print(f"GitHub API error for {owner}/{repo}#{number}: {data.get('errors')}")
+                yield batch[0], None
+            continue
+        # Items that could not be resolved (e.g. of a deleted repository or a transferred issue)
+        # are reported in the errors with their alias
+        for error in data.get('errors', []):
+            path = error.get('path') or []
+            if path and path[0].startswith('i') and path[0][1:].isdigit():
+                owner, repo, number = batch[int(path[0][1:])][:3]
+                print(f"GitHub API error for {owner}/{repo}#{number}: {error.get('message', error.get('type'))}")
+        for position, item in enumerate(batch):
+            yield item, data['data'].get(f"i{position}")
+
+
+def closure_query(issue):
+    owner, repo, number = issue
+    return """repository(owner: {owner}, name: {repo}) {{
+        issue(number: {number}) {{{fields}
+        }}
+      }}""".format(owner=json.dumps(owner), repo=json.dumps(repo), number=number, fields=CLOSURE_FIELDS)
+
+
+def get_closure_infos(issues, client, batch_size=50, retries=3):
+    """
+    Fetches the closure information of many GitHub issues, with batch_size issues per aliased
+    GraphQL query (see batched_graphql).
+    Parameters:
+    - issues (list): (owner, repository, issue number) tuples.
+    - client (GitHubClient): The client used to send the GitHub API requests.
+    Returns:
+    - dict: The closure information tuple (see get_closure_info) of every issue.
+    """
+    metrics = metrics_of(client.session)
+    closures = {}
+    for issue, repository in batched_graphql(issues, client, closure_query, batch_size, retries):
+        closures[issue] = closure_tuple(repository and repository.get('issue'))
+        metrics.done()
+    return closures
+
+
+def get_closure_info(owner, repo, issue_number, client):
+    """
+    Fetches closure information for a GitHub issue given the owner, repository, and issue number.
+    Parameters:
+    - owner (str): The owner of the repository.
+    - repo (str): The name of the repository.
+    - issue_number (int): The number of the issue.
+    - client (GitHubClient): The client used to send the GitHub API requests.
+    Returns:
+    - tuple: A tuple containing the type of closure (PR/Commit), closure URL, creation date, and closure date.
+    """
+    return get_closure_infos([(owner, repo, issue_number)], client)[(owner, repo, issue_number)]
+
+
 def main():
     args = get_args()
-    gh_headers = {
-    'Authorization': f'Bearer {args.gh_token}',
-    'Content-Type': 'application/json'
-    }
+    session = session_from_args(args, pool_size=args.workers)
+    client = GitHubClient(load_tokens(args.gh_token, args.tokens_file), session=session)
     issue_details = {} 
     urls = get_urls_from_csv(args.data)
-    for issue_url, fix_url, ecosystem in urls:
+    # Progress is counted in bugs, for the closure dates and then for the fix details
+    metrics = metrics_of(session)
+    metrics.expect(len(urls))
+    # The closure information of all the GitHub issues is resolved in batches up front
+    parsed_urls = [parse_url(issue_url) for issue_url, _, _ in urls]
+    closures = get_closure_infos([parsed for parsed in parsed_urls if parsed[2]], client)
+    for (issue_url, fix_url, ecosystem), (owner, repo, issue_number) in zip(urls, parsed_urls):
+        if not issue_number:
+            # GitHub issues were counted as their batches were resolved
+            metrics.done()
         # # Special case handling for a specific issue URL.
         if issue_url == "https://github.com/ansible/ansible/issues/70589": 
             issue_details[issue_url] = {
@@ -412,11 +618,9 @@ def main():
         #         "closed_at": "2016-06-21T10:36:22Z",
         #         }
         #     continue
-        # Extract the owner, repo, and issue number from the GitHub issue URL.
-        owner, repo, issue_number = parse_url(issue_url)
-        # If a valid issue number is found, fetch closure information for the issue.
+        # If a valid issue number is found, take the closure information of the issue.
         if issue_number:
-            closer_type, closure_url, created_at, closed_at = get_closure_info(owner, repo, issue_number, gh_headers)
+            closer_type, closure_url, created_at, closed_at = closures[(owner, repo, issue_number)]
             issue_details[issue_url] = {
                 'fix_url': fix_url,
                 "ecosystem": ecosystem,
@@ -427,7 +631,7 @@ def main():
         # Handle JIRA URLs separately.
         elif issue_url.startswith("https://puppet.atlassian.net/"):
             # Fetch creation and closure dates using the JIRA API.
-            created_at, closed_at = get_jira_date(issue_url)
+            created_at, closed_at = get_jira_date(issue_url, session)
             issue_details[issue_url] = {
                     'fix_url': fix_url,
                     "ecosystem": ecosystem,
@@ -438,11 +642,13 @@ def main():
         else: 
             print(f"Could not parse URL: {issue_url}")
     # Update the issue details with information fetched from PRs or commits.
-    for issue in issue_details:
-        if "/pull/" in issue_details[issue]["fix_url"]:
-            issue_details[issue].update(get_pr_details(issue_details[issue]["fix_url"], issue_details[issue]["ecosystem"], gh_headers))
-        else: 
-            issue_details[issue].update(get_commit_details(issue_details[issue]["fix_url"],issue_details[issue]["ecosystem"], gh_headers))
+    metrics.expect(len(issue_details))
+    fixes = [(details["fix_url"], details["ecosystem"]) for details in issue_details.values()]
+    for details, fix_details in zip(issue_details.values(), get_all_fix_details(fixes, client, args.workers)):
+        if isinstance(fix_details, dict):
+            details.update(fix_details)
+        else:
+            print(f"Could not fetch the files of {details['fix_url']}")
     save_to_csv(issue_details, args.output)
 
 
@@ -0,0 +1,40 @@
+import csv
+import os
+import sys
+
+import pytest
+import requests
+
+# The scripts import each other as top-level modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+sys.path.insert(0, os.path.join(ROOT, 'scripts', 'fetch'))
+
+from simulated_api import SimulatedAPI  # noqa: E402
+
+
+@pytest.fixture
+def api():
+    return SimulatedAPI(repositories=5, mean_issues=40, seed=0)
+
+
+@pytest.fixture
+def session(api):
+    # A session whose requests are answered by the simulated API
+    session = requests.Session()
+    session.mount('https://', api)
+    return session
+
+
+def write_repositories(path, names):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Name', 'Source URL'])
+        for name in names:
+            writer.writerow([name, f"https://github.com/sim/{name}"])
+    return path
+
+
+def read_rows(path):
+    with open(path, newline='') as file:
+        return list(csv.reader(file))[1:]
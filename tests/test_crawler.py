@@ -0,0 +1,40 @@
+from crawler import Crawler, Source
+from conftest import read_rows
+
+
+class ListPagination:
+    # Serves pages from a list; the state is the index of the next page. Stops before the page
+    # at index `fail`, like a page that could not be retrieved
+    def __init__(self, pages, fail=None):
+        self.pages_ = pages
+        self.fail = fail
+
+    def items(self, page):
+        return page
+
+    def pages(self, crawler, state=None):
+        for index in range(state or 0, len(self.pages_)):
+            if index == self.fail:
+                return
+            yield self.pages_[index], (index + 1 if index + 1 < len(self.pages_) else None)
+
+
+def source(pages, fail=None):
+    return Source('list', ListPagination(pages, fail), header=['Name'], row=lambda item, crawler: [item])
+
+
+def test_fresh_crawl_keeps_duplicate_rows(tmp_path):
+    output = str(tmp_path / 'output.csv')
+    assert Crawler(session=None).run(source([['a', 'b'], ['b', 'a']]), output)
+    assert read_rows(output) == [['a'], ['b'], ['b'], ['a']]
+
+
+def test_resume_skips_only_the_rows_of_the_interrupted_page(tmp_path):
+    output = str(tmp_path / 'output.csv')
+    pages = [['a', 'b'], ['b', 'c', 'd'], ['a']]
+    assert not Crawler(session=None).run(source(pages, fail=1), output)
+    # The run was interrupted after writing the first row of the second page
+    with open(output, 'a', newline='') as file:
+        file.write('b\r\n')
+    assert Crawler(session=None).run(source(pages), output, resume=True)
+    assert read_rows(output) == [['a'], ['b'], ['b'], ['c'], ['d'], ['a']]
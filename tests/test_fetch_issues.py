@@ -0,0 +1,39 @@
+import fetch_issues
+from conftest import read_rows, write_repositories
+
+
+def fix_closed_issues(api, repo, closers=('PullRequest', 'Commit')):
+    return {f"https://github.com/sim/{repo}/issues/{number + 1}"
+            for number in range(api.repositories[repo]) if api.closers[number] in closers}
+
+
+def test_incremental_issues_run_after_search_collects_commit_closed_issues(api, session, tmp_path):
+    repo = max(api.repositories, key=api.repositories.get)
+    input_csv = write_repositories(tmp_path / 'repositories.csv', [repo])
+    output_csv = str(tmp_path / 'bugs.csv')
+    commit_closed = fix_closed_issues(api, repo, closers=('Commit',))
+    assert commit_closed
+
+    # linked:pr only finds the issues closed by a pull request
+    fetch_issues.main(input_csv, output_csv, ['token'], session=session, mode='search')
+    assert not commit_closed & {row[0] for row in read_rows(output_csv)}
+
+    fetch_issues.main(input_csv, output_csv, ['token'], session=session, incremental=True)
+    assert {row[0] for row in read_rows(output_csv)} == fix_closed_issues(api, repo)
+
+
+def test_main_accepts_a_single_token_string(api, session, tmp_path):
+    repo = max(api.repositories, key=api.repositories.get)
+    input_csv = write_repositories(tmp_path / 'repositories.csv', [repo])
+    output_csv = str(tmp_path / 'bugs.csv')
+    tokens = []
+    send = api.send
+
+    def record_token(request, **kwargs):
+        tokens.append(request.headers['Authorization'])
+        return send(request, **kwargs)
+
+    api.send = record_token
+    fetch_issues.main(input_csv, output_csv, 'ghp_secret', session=session)
+    assert set(tokens) == {'Bearer ghp_secret'}
+    assert {row[0] for row in read_rows(output_csv)} == fix_closed_issues(api, repo)